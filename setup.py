@@ -6,7 +6,6 @@ setup(
     license="GPLv3",
     packages=find_packages(),
     install_requires=[
-        'logzero',
-        'rx'
+        'logzero'
     ],
 )
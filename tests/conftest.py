@@ -1,3 +1,4 @@
+import asyncio
 import random
 import socket
 import string
@@ -6,6 +7,7 @@ import io
 import pytest
 
 from workq.net.stream import Stream
+from workq.worker.stream import StreamWrapper
 
 
 class AsyncBytesIOChannel:
@@ -34,6 +36,59 @@ class AsyncBytesIOChannel:
         self.read_head = at
 
 
+class FakeClient:
+    """Stands in for orchestrator.client.Client in scheduling tests."""
+
+    def __init__(self, name, capacity=8):
+        self.name = name
+        self.identity = name
+        self.capacity = capacity
+        self.in_flight = 0
+        self.stealable = 0
+        self.pools = []
+        self.work = []
+        self.detached = []
+        self.service_time = None
+        self.rtt = None
+
+    @property
+    def load(self):
+        return self.in_flight / self.capacity
+
+    def set_in_flight(self, in_flight):
+        self.in_flight = in_flight
+        for pool in self.pools:
+            pool.update(self)
+
+    def start(self, task, args, kwargs, timeout=None):
+        future = asyncio.get_event_loop().create_future()
+        self.work.append((args, future))
+        self.set_in_flight(self.in_flight + 1)
+        return future
+
+    def start_batch(self, task, arglist, timeout=None):
+        return self.start(task, arglist, None, timeout)
+
+    def start_detached(self, task, args, kwargs, timeout=None):
+        self.detached.append(args)
+        self.set_in_flight(self.in_flight + 1)
+
+    def finish(self, result=None, exception=None, index=0):
+        args, future = self.work.pop(index)
+        self.set_in_flight(self.in_flight - 1)
+        if exception is None:
+            future.set_result(result)
+        else:
+            future.set_exception(exception)
+
+        return args
+
+
+@pytest.fixture
+def fake_client():
+    return FakeClient
+
+
 @pytest.fixture
 def channel():
     channel = AsyncBytesIOChannel()
@@ -68,6 +123,29 @@ def streampair_generator(event_loop):
     return gen()
 
 
+@pytest.fixture
+def worker_streampair(event_loop):
+    """A worker's connected `StreamWrapper`, and the `Stream` of the server at the other end."""
+    worker, server = socket.socketpair()
+    worker.setblocking(False)
+    server.setblocking(False)
+
+    stream = StreamWrapper(1, loop=event_loop)
+    stream.socket = worker
+    stream.backing = Stream(worker, loop=event_loop)
+    stream.available.set()
+    return stream, Stream(server, loop=event_loop)
+
+
+@pytest.fixture
+def worker_streampair_generator(event_loop):
+    def gen():
+        while True:
+            yield worker_streampair(event_loop)
+
+    return gen()
+
+
 def random_int(maxdepth=1):
     return random.randint(-2**32, 2**32)
 
@@ -0,0 +1,79 @@
+import asyncio
+
+import pytest
+
+from workq.net.flow import ItemStream
+from workq.net.messages import Flags, Types, Message, work_item
+from workq.orchestrator.client import Client
+
+
+class SentStream:
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, msg, materialize=True):
+        self.sent.append(msg)
+
+
+@pytest.fixture
+def client():
+    client = Client('worker', 1, SentStream(), capacity=4)
+    client.task_ids['task'] = 1
+    return client
+
+
+@pytest.mark.asyncio
+async def test_stream_without_items(client):
+    empty = client.start('task', (), {})
+    items = client.start('task', (), {})
+
+    await client.work_done(Message(Types.WORK_COMPLETE, Flags.ITEMS, work_id=0))
+    client.work_item(work_item(1, 'item'))
+    await client.work_done(Message(Types.WORK_COMPLETE, Flags.ITEMS, work_id=1))
+
+    assert isinstance(await empty, ItemStream)
+    assert [item async for item in await empty] == []
+    assert [item async for item in await items] == ['item']
+    assert not client.in_flight
+
+
+@pytest.mark.asyncio
+async def test_dropping_a_stream_cancels_the_work(event_loop, client):
+    broken = client.start('task', (), {})
+    closed = client.start('task', (), {})
+    for work_id in range(2):
+        for item in range(3):
+            client.work_item(work_item(work_id, item))
+
+    async for item in await broken:
+        break
+    async with await closed as items:
+        assert await items.__anext__() == 0
+    del broken, items
+    for _ in range(2):
+        await asyncio.sleep(0, loop=event_loop)
+
+    cancels = [msg.work_id for msg in client.stream.sent if msg.type == Types.CANCEL]
+    assert sorted(cancels) == [0, 1]
+
+    # The worker confirms, and its remaining items are discarded
+    client.work_item(work_item(0, 3))
+    for work_id in range(2):
+        await client.work_done(Message(Types.WORK_COMPLETE, Flags.ITEMS | Flags.ERROR, work_id=work_id))
+    assert not client.in_flight and not client.streams
+
+
+@pytest.mark.asyncio
+async def test_service_time_of_calls_that_succeed(event_loop, client):
+    client.start_batch('task', [(1,), (2,), (3,), (4,)])
+    client.start('task', (), {})
+    client.start('task', (), {}).cancel()
+    for work_id, (_, calls) in list(client.started.items()):
+        client.started[work_id] = event_loop.time() - 1, calls
+
+    await client.work_done(Message(Types.WORK_COMPLETE, Flags.ERROR, work_id=1, payload='trace'))
+    await client.work_done(Message(Types.WORK_COMPLETE, work_id=2))
+    assert client.service_time is None
+
+    await client.work_done(Message(Types.WORK_COMPLETE, work_id=0, payload=[(True, None)] * 4))
+    assert 1 / 4 <= client.service_time < 1 / 3
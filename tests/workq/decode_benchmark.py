@@ -0,0 +1,40 @@
+import asyncio
+import time
+
+import pytest
+
+from workq.net.messages import Message, Types
+
+ROUNDS = 10
+
+
+async def timed_decode(r, w, objects, event_loop):
+    async def send_all():
+        for _ in range(ROUNDS):
+            for obj in objects:
+                await w.send(Message(Types.WORK_COMPLETE, payload=obj))
+
+    write_task = asyncio.ensure_future(send_all(), loop=event_loop)
+
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        for obj in objects:
+            assert obj == (await r.decode()).payload
+    elapsed = time.perf_counter() - start
+
+    await write_task
+    return elapsed
+
+
+@pytest.mark.asyncio
+async def test_whole_frame_vs_opcode_decode(event_loop, streampair_generator, objects):
+    r, w = next(streampair_generator)
+    whole_frame = await timed_decode(r, w, objects, event_loop)
+
+    r, w = next(streampair_generator)
+    r.max_frame_size = 0  # Force every frame through the async unpickler
+    opcode = await timed_decode(r, w, objects, event_loop)
+
+    n = ROUNDS * len(objects)
+    print(f"\nwhole-frame decode: {n / whole_frame:.0f} msg/s, opcode decode: {n / opcode:.0f} msg/s "
+          f"({opcode / whole_frame:.1f}x)")
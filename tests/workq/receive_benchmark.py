@@ -0,0 +1,63 @@
+import asyncio
+import time
+from functools import partial
+
+import pytest
+
+from workq.net.messages import grant_credit
+
+MESSAGES = 20000
+
+
+def rx_listen(stream, handler, loop):
+    """The receive pipeline the worker used before `StreamWrapper.listen`, as a baseline."""
+    rx = pytest.importorskip('rx')
+    import rx.concurrency
+
+    def subscribe(observer):
+        async def push_values():
+            while True:
+                observer.on_next(await stream.decode())
+
+        task = asyncio.ensure_future(push_values(), loop=loop)
+        return task.cancel
+
+    observable = rx.Observable.create(subscribe).subscribe_on(rx.concurrency.AsyncIOScheduler(loop)).share()
+    return observable.subscribe(handler).dispose
+
+
+async def timed_receive(listen, worker_streampair, event_loop):
+    stream, w = worker_streampair
+    received = []
+    done = event_loop.create_future()
+
+    def handler(message):
+        received.append(message)
+        if len(received) == MESSAGES:
+            done.set_result(None)
+
+    async def send_all():
+        for i in range(MESSAGES):
+            await w.send(grant_credit(i, 1))
+
+    start = time.perf_counter()
+    stop = listen(stream, handler)
+    await asyncio.gather(send_all(), done, loop=event_loop)
+    elapsed = time.perf_counter() - start
+    stop()
+
+    assert [message.work_id for message in received] == list(range(MESSAGES))
+    return elapsed
+
+
+@pytest.mark.asyncio
+async def test_receive_loop_vs_observable(event_loop, worker_streampair_generator):
+    def listen(stream, handler):
+        return stream.listen(handler).cancel
+
+    direct = await timed_receive(listen, next(worker_streampair_generator), event_loop)
+    observable = await timed_receive(partial(rx_listen, loop=event_loop), next(worker_streampair_generator),
+                                     event_loop)
+
+    print(f"\nreceive loop: {MESSAGES / direct:.0f} msg/s, rx observable: {MESSAGES / observable:.0f} msg/s "
+          f"({observable / direct:.1f}x)")
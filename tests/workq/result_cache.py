@@ -0,0 +1,88 @@
+from workq.interface import Interface
+from workq.orchestrator.cache import ResultCache, estimate_size
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_hits_and_misses():
+    cache = ResultCache()
+    key = cache.key((1, 2), {'c': 3})
+
+    assert cache.get(key) == (False, None)
+    cache.put(key, 6)
+    assert cache.get(key) == (True, 6)
+    assert cache.get(cache.key((1, 2), {'c': 4})) == (False, None)
+
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_stable_key():
+    assert ResultCache.key((1,), {'a': 1, 'b': 2}) == ResultCache.key((1,), {'b': 2, 'a': 1})
+    assert ResultCache.key(({'x': 1, 'y': {3, 2, 1}},), {}) == ResultCache.key(({'y': {1, 2, 3}, 'x': 1},), {})
+    assert ResultCache.key(([1], {1}), {}) != ResultCache.key(((1,), frozenset({1})), {})
+    shared = ''.join(['a', 'b'])
+    assert ResultCache.key((shared, shared), {}) == ResultCache.key((shared, 'ab'), {})
+    assert ResultCache.key((lambda: None,), {}) is None
+
+
+def test_least_recently_used_evicted():
+    cache = ResultCache(maxsize=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.get('a')
+    cache.put('c', 3)
+
+    assert cache.get('b') == (False, None)
+    assert cache.get('a') == (True, 1)
+    assert cache.evictions == 1
+
+
+def test_byte_budget():
+    cache = ResultCache(max_bytes=3000)
+    cache.put('a', bytes(1000))
+    cache.put('b', bytes(1000))
+    cache.put('c', bytes(1000))
+
+    assert len(cache) == 2 and cache.bytes <= 3000
+    cache.put('huge', bytes(5000))
+    assert cache.get('huge') == (False, None)
+
+
+def test_ttl():
+    clock = Clock()
+    cache = ResultCache(ttl=10, clock=clock)
+    cache.put('a', 1)
+
+    clock.now = 9
+    assert cache.get('a') == (True, 1)
+    clock.now = 10
+    assert cache.get('a') == (False, None)
+    assert len(cache) == 0
+
+
+def test_task_cache_option():
+    interface = Interface("cached")
+
+    @interface.task(cache={'ttl': 60})
+    def pure(a):
+        pass
+
+    @interface.task
+    def impure(a):
+        pass
+
+    assert interface.pure.cache == {'ttl': 60}
+    assert interface.impure.cache is None
+
+
+def test_estimated_size():
+    assert 1000 <= estimate_size(bytes(1000)) < 1100
+    assert 1000 <= estimate_size(memoryview(bytes(1000))) < 1300
+    assert 100000 <= estimate_size([bytes(1000)] * 100) < 120000
+    assert 100000 <= estimate_size({i: bytes(1000) for i in range(100)}) < 120000
@@ -0,0 +1,690 @@
+import asyncio
+
+import pytest
+
+from workq.orchestrator import Server
+from workq.orchestrator.client import ClientDisconnectedException, WorkException, WorkReleasedException
+from workq.orchestrator.scheduling import WorkerPool, TaskQueue, LatencyTracker, HashRing, affinity_hash
+from workq.net.flow import ItemStream
+from workq.net.messages import Message, Types
+from workq.net.upload import Upload
+
+
+@pytest.fixture
+def clients(fake_client):
+    return [fake_client(i) for i in range(4)]
+
+
+@pytest.fixture
+def pool(clients):
+    pool = WorkerPool()
+    for client in clients:
+        pool.add(client)
+
+    return pool
+
+
+def test_empty_pool():
+    assert WorkerPool().select() is None
+
+
+def test_idle_first_in_first_out(pool, clients):
+    for client in clients:
+        assert pool.select() is client
+        client.set_in_flight(1)
+
+    clients[2].set_in_flight(0)
+    clients[0].set_in_flight(0)
+
+    assert pool.select() is clients[2]
+    clients[2].set_in_flight(1)
+    assert pool.select() is clients[0]
+
+
+def test_least_loaded_when_all_busy(pool, clients):
+    for load, client in zip([3, 1, 4, 2], clients):
+        client.set_in_flight(load)
+
+    assert pool.select() is clients[1]
+
+    clients[1].set_in_flight(5)
+    assert pool.select() is clients[3]
+
+    clients[2].set_in_flight(1)
+    assert pool.select() is clients[2]
+
+
+def test_remove(pool, clients):
+    clients[0].set_in_flight(1)
+    pool.remove(clients[1])
+    pool.remove(clients[2])
+    pool.remove(clients[3])
+
+    assert len(pool) == 1
+    assert pool.select() is clients[0]
+
+    pool.remove(clients[0])
+    assert pool.select() is None
+    assert clients[0].pools == []
+
+
+def test_stale_entries_are_compacted(pool, clients):
+    for load in range(1, 1000):
+        clients[0].set_in_flight(load)
+
+    assert len(pool.busy) <= 2 * len(pool) + 16
+
+
+def test_least_utilized_with_free_slots(fake_client):
+    small, large = fake_client('small', capacity=1), fake_client('large', capacity=64)
+    pool = WorkerPool()
+    pool.add(small)
+    pool.add(large)
+
+    small.set_in_flight(1)
+    large.set_in_flight(10)
+    assert pool.select() is large
+
+    large.set_in_flight(64)
+    assert pool.select() is None
+
+
+@pytest.mark.asyncio
+async def test_acquire_waits_for_free_slot(event_loop, pool, clients):
+    for client in clients:
+        client.set_in_flight(client.capacity)
+
+    waiters = [asyncio.ensure_future(pool.acquire(), loop=event_loop) for _ in range(2)]
+    await asyncio.sleep(0, loop=event_loop)
+    assert not any(waiter.done() for waiter in waiters)
+
+    clients[1].set_in_flight(clients[1].capacity - 1)
+    assert await waiters[0] is clients[1]
+    assert not waiters[1].done()
+
+    clients[1].set_in_flight(clients[1].capacity)
+    clients[3].set_in_flight(0)
+    assert await waiters[1] is clients[3]
+
+
+@pytest.mark.asyncio
+async def test_cancelled_waiter_passes_slot_on(event_loop, pool, clients):
+    for client in clients:
+        client.set_in_flight(client.capacity)
+
+    first, second = [asyncio.ensure_future(pool.acquire(), loop=event_loop) for _ in range(2)]
+    await asyncio.sleep(0, loop=event_loop)
+
+    clients[0].set_in_flight(clients[0].capacity - 1)
+    first.cancel()
+
+    assert await second is clients[0]
+
+
+class FakeTask:
+    name = 'task'
+    signature = 'task'
+    pretty_name = 'interface.task()'
+    cache = None
+    coalesce = False
+    hedge = None
+    affinity = None
+
+
+@pytest.mark.asyncio
+async def test_queue_hands_out_calls_as_slots_free(event_loop, fake_client):
+    client = fake_client('worker', capacity=1)
+    pool = WorkerPool()
+    queue = TaskQueue(FakeTask(), pool, loop=event_loop)
+
+    results = [await queue.put((i,), {}) for i in range(3)]
+    await asyncio.sleep(0, loop=event_loop)
+    assert len(queue) == 3
+
+    pool.add(client)
+    await asyncio.sleep(0, loop=event_loop)
+    assert len(queue) == 2 and len(client.work) == 1
+
+    for i in range(3):
+        assert client.finish(i) == (i,)
+        assert await results[i] == i
+        await asyncio.sleep(0, loop=event_loop)
+
+    queue.close()
+
+
+@pytest.mark.asyncio
+async def test_queue_admission_backpressure(event_loop):
+    queue = TaskQueue(FakeTask(), WorkerPool(), maxsize=2, loop=event_loop)
+
+    queued = [await queue.put((i,), {}) for i in range(2)]
+    admission = asyncio.ensure_future(queue.put((2,), {}), loop=event_loop)
+    await asyncio.sleep(0, loop=event_loop)
+    assert not admission.done()
+
+    queued[0].cancel()
+    await asyncio.sleep(0, loop=event_loop)  # The dispatcher drops the cancelled call
+    await asyncio.sleep(0, loop=event_loop)
+    assert admission.done()
+    assert len(queue) == 2
+
+    queue.close()
+
+
+@pytest.mark.asyncio
+async def test_failing_affinity_takes_no_room(event_loop):
+    task = FakeTask()
+    task.affinity = lambda key: {None: 'key'}[key]
+    queue = TaskQueue(task, WorkerPool(), maxsize=1, loop=event_loop)
+
+    queued = await queue.put((None,), {})
+    with pytest.raises(KeyError):
+        await queue.put(('missing',), {})
+
+    admission = asyncio.ensure_future(queue.put((None,), {}), loop=event_loop)
+    queued.cancel()
+    await asyncio.sleep(0, loop=event_loop)
+    await asyncio.sleep(0, loop=event_loop)
+    assert admission.done() and len(queue) == 1
+
+    queue.close()
+
+
+@pytest.mark.asyncio
+async def test_detached_calls_are_done_once_sent(event_loop, fake_client):
+    client = fake_client('worker', capacity=2)
+    pool = WorkerPool()
+    pool.add(client)
+    queue = TaskQueue(FakeTask(), pool, maxsize=3, loop=event_loop)
+
+    calls = [queue.put_nowait((i,), {}, detached=True) for i in range(3)]
+    with pytest.raises(asyncio.QueueFull):
+        queue.put_nowait((3,), {}, detached=True)
+
+    await asyncio.sleep(0, loop=event_loop)
+    assert client.detached == [(0,), (1,)] and len(queue) == 1
+    assert [call.result() for call in calls[:2]] == [None, None]
+
+    # The slots stay taken until the client reports the detached work as completed
+    client.set_in_flight(0)
+    await asyncio.sleep(0, loop=event_loop)
+    assert client.detached == [(0,), (1,), (2,)] and calls[2].done()
+
+    queue.close()
+
+
+@pytest.mark.asyncio
+async def test_queue_restarts_call_on_disconnect(event_loop, fake_client):
+    first, second = fake_client('first', capacity=1), fake_client('second', capacity=1)
+    pool = WorkerPool()
+    pool.add(first)
+    queue = TaskQueue(FakeTask(), pool, loop=event_loop)
+
+    result = await queue.put((), {})
+    await asyncio.sleep(0, loop=event_loop)
+
+    pool.remove(first)
+    pool.add(second)
+    first.finish(exception=ClientDisconnectedException())
+    await asyncio.sleep(0, loop=event_loop)
+    await asyncio.sleep(0, loop=event_loop)
+
+    second.finish('done')
+    assert await result == 'done'
+
+    queue.close()
+
+
+@pytest.mark.asyncio
+async def test_queue_priority_with_aging(event_loop, fake_client):
+    client = fake_client('worker', capacity=1)
+    pool = WorkerPool()
+    queue = TaskQueue(FakeTask(), pool, aging=0.001, loop=event_loop)
+
+    low = await queue.put(('low',), {})
+    high = await queue.put(('high',), {}, priority=2)
+
+    # Having waited longer than three levels of priority are worth, the low priority call goes ahead of a new one
+    await asyncio.sleep(0.005, loop=event_loop)
+    higher = await queue.put(('higher',), {}, priority=3)
+
+    pool.add(client)
+    await asyncio.sleep(0, loop=event_loop)
+
+    order = []
+    for _ in range(3):
+        order.append(client.finish()[0])
+        await asyncio.sleep(0, loop=event_loop)
+
+    assert order == ['high', 'low', 'higher']
+    assert high.done() and low.done() and higher.done()
+    assert queue.waits[2].count == 1 and queue.waits[0].count == 1
+    assert queue.waits[0].max >= queue.waits[3].max
+
+    queue.close()
+
+
+@pytest.mark.asyncio
+async def test_map_batches_calls(event_loop, fake_client):
+    client = fake_client('worker', capacity=2)
+    server = Server(max_queued=2)
+    task = FakeTask()
+    task.member_of = task
+    server.clients_supporting[task.signature].add(client)
+
+    async def worker():
+        while True:
+            await asyncio.sleep(0, loop=event_loop)
+            if client.work:
+                # Complete the newest batch first, so batches complete out of order
+                arglist, _ = client.work[-1]
+                client.finish([(a != 3, a * 2) for a, in arglist], index=-1)
+
+    working = asyncio.ensure_future(worker(), loop=event_loop)
+
+    unordered = [result async for result in server.map_task(task, [(i,) for i in range(3)], 2, ordered=False)]
+    assert sorted(unordered) == [0, 2, 4]
+
+    ordered = [result async for result in server.map_task(task, [(i,) for i in range(3)], 2)]
+    assert ordered == [0, 2, 4]
+
+    results = server.map_task(task, [(i,) for i in range(5)], 1)
+    assert [await results.__anext__() for _ in range(3)] == [0, 2, 4]
+    with pytest.raises(WorkException):
+        await results.__anext__()
+
+    working.cancel()
+    server.alive = False
+    server.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_identical_calls_coalesce(event_loop, fake_client):
+    client = fake_client('worker')
+    server = Server()
+    task = FakeTask()
+    task.member_of = task
+    task.coalesce = True
+    server.clients_supporting[task.signature].add(client)
+
+    calls = [asyncio.ensure_future(server.start_task(task, (i % 2,), {}), loop=event_loop) for i in range(6)]
+    await asyncio.sleep(0.01, loop=event_loop)
+    assert len(client.work) == 2
+
+    calls[0].cancel()
+    client.finish('even')
+    client.finish('odd')
+
+    assert await asyncio.gather(*calls[1:], loop=event_loop) == ['odd', 'even', 'odd', 'even', 'odd']
+    assert not server.flights
+
+    server.alive = False
+    server.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_coalesced_call_is_cancelled_with_its_last_caller(event_loop, fake_client):
+    client = fake_client('worker')
+    server = Server()
+    task = FakeTask()
+    task.member_of = task
+    task.coalesce = True
+    server.clients_supporting[task.signature].add(client)
+
+    patient = asyncio.ensure_future(server.start_task(task, (), {}), loop=event_loop)
+    hasty = asyncio.ensure_future(server.start_task(task, (), {}, timeout=0.01), loop=event_loop)
+    urgent = asyncio.ensure_future(server.start_task(task, (), {}, priority=1), loop=event_loop)
+    await asyncio.sleep(0.005, loop=event_loop)
+    assert len(client.work) == 2
+
+    with pytest.raises(asyncio.TimeoutError):
+        await hasty
+    (_, flight), (_, other) = client.work
+    assert not flight.done()
+
+    patient.cancel()
+    urgent.cancel()
+    await asyncio.sleep(0, loop=event_loop)
+    await asyncio.sleep(0, loop=event_loop)
+    assert flight.cancelled() and other.cancelled()
+    assert not server.flights
+
+    server.alive = False
+    server.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_coalesced_calls_do_not_share_a_stream(event_loop, fake_client):
+    client = fake_client('worker')
+    server = Server()
+    task = FakeTask()
+    task.member_of = task
+    task.coalesce = True
+    server.clients_supporting[task.signature].add(client)
+
+    calls = [asyncio.ensure_future(server.start_task(task, (), {}), loop=event_loop) for _ in range(2)]
+    await asyncio.sleep(0.01, loop=event_loop)
+    streamed = ItemStream(lambda items: None)
+    client.finish(streamed)
+    await asyncio.sleep(0.01, loop=event_loop)
+
+    # The second caller makes a call of its own
+    assert len(client.work) == 1
+    client.finish('another')
+    assert await asyncio.gather(*calls, loop=event_loop) == [streamed, 'another']
+
+    server.alive = False
+    server.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_leaving_client_gets_no_more_work(event_loop, fake_client):
+    leaving, staying = fake_client('leaving'), fake_client('staying')
+    server = Server()
+    task = FakeTask()
+    task.member_of = task
+    for client in (leaving, staying):
+        client.supported_interfaces = [task]
+        server.clients_supporting[task.signature].add(client)
+
+    await server.leave(leaving, Message(Types.LEAVE))
+    results = [await server.submit(task, (i,), {}) for i in range(4)]
+    await asyncio.sleep(0, loop=event_loop)
+    assert not leaving.work and len(staying.work) == 4
+
+    # Once it disconnects, it is withdrawn again
+    server.withdraw(leaving)
+    assert not leaving.pools
+
+    for result in results:
+        result.cancel()
+    server.alive = False
+    server.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_deadline_cancels_queued_and_running_calls(event_loop, fake_client):
+    client = fake_client('worker', capacity=1)
+    pool = WorkerPool()
+    pool.add(client)
+    queue = TaskQueue(FakeTask(), pool, loop=event_loop)
+
+    running = await queue.put(('running',), {}, timeout=0.01)
+    queued = await queue.put(('queued',), {}, timeout=0.01)
+    await asyncio.sleep(0, loop=event_loop)
+    assert len(client.work) == 1 and len(queue) == 1
+
+    with pytest.raises(asyncio.TimeoutError):
+        await running
+    with pytest.raises(asyncio.TimeoutError):
+        await queued
+
+    await asyncio.sleep(0, loop=event_loop)
+    _, work = client.work[0]
+    assert work.cancelled()
+    assert len(queue) == 0
+
+    queue.close()
+
+
+def test_victim_could_give_back_the_most(pool, clients):
+    assert pool.victim() is None
+
+    for client, stealable in zip(clients, (2, 5, 1, 3)):
+        client.stealable = stealable
+        client.set_in_flight(stealable)
+    assert pool.victim() is clients[1]
+
+    clients[1].stealable = 1
+    clients[1].set_in_flight(1)
+    assert pool.victim() is clients[3]
+
+    pool.remove(clients[3])
+    assert pool.victim() is clients[0]
+
+
+def test_select_excluding(pool, clients):
+    assert pool.select(exclude=clients[0]) is clients[1]
+
+    for in_flight, client in zip([1, 2, 3, 8], clients):
+        client.set_in_flight(in_flight)
+
+    assert pool.select(exclude=clients[0]) is clients[1]
+    assert pool.select() is clients[0]
+
+
+def test_latency_percentile():
+    latency = LatencyTracker(window=100, min_samples=10)
+    for sample in range(9):
+        latency.add(sample)
+    assert latency.percentile(0.5) is None
+
+    for sample in range(9, 200):
+        latency.add(sample)
+
+    assert len(latency) == 100
+    assert latency.percentile(0.5) == 150
+    assert latency.percentile(0.99) == 199
+    assert latency.percentile(1) == 199
+
+
+@pytest.mark.asyncio
+async def test_straggler_is_hedged(event_loop, fake_client):
+    slow, fast = fake_client('slow', capacity=1), fake_client('fast', capacity=1)
+    pool = WorkerPool()
+    pool.add(slow)
+    pool.add(fast)
+    task = FakeTask()
+    task.hedge = 0.9
+    queue = TaskQueue(task, pool, loop=event_loop)
+    for _ in range(20):
+        queue.latency.add(0.001)
+
+    result = await queue.put(('straggler',), {})
+    await asyncio.sleep(0.01, loop=event_loop)
+    assert len(slow.work) == 1 and len(fast.work) == 1
+
+    fast.finish('fast')
+    assert await result == 'fast'
+
+    await asyncio.sleep(0, loop=event_loop)
+    _, work = slow.work[0]
+    assert work.cancelled()
+    assert queue.hedged == queue.hedges_won == 1
+    assert len(queue.latency) == 21
+
+    queue.close()
+
+
+@pytest.mark.asyncio
+async def test_batch_is_not_hedged_or_timed(event_loop, fake_client):
+    slow, fast = fake_client('slow', capacity=1), fake_client('fast', capacity=1)
+    pool = WorkerPool()
+    pool.add(slow)
+    pool.add(fast)
+    task = FakeTask()
+    task.hedge = 0.9
+    queue = TaskQueue(task, pool, loop=event_loop)
+    for _ in range(20):
+        queue.latency.add(0.001)
+
+    batch = await queue.put([(i,) for i in range(64)], None)
+    await asyncio.sleep(0.01, loop=event_loop)
+    assert queue.hedged == 0 and len(slow.work) + len(fast.work) == 1
+
+    (slow if slow.work else fast).finish([(True, i) for i in range(64)])
+    await batch
+    await asyncio.sleep(0, loop=event_loop)
+    assert len(queue.latency) == 20
+
+    queue.close()
+
+
+@pytest.mark.asyncio
+async def test_no_hedge_while_other_calls_wait(event_loop, fake_client):
+    pool = WorkerPool()
+    pool.add(fake_client('slow', capacity=1))
+    pool.add(fake_client('free', capacity=1))
+    task = FakeTask()
+    task.hedge = 0.9
+    queue = TaskQueue(task, pool, loop=event_loop)
+    for _ in range(20):
+        queue.latency.add(0.001)
+
+    pool.waiters.append(event_loop.create_future())  # Woken for the free slot, but not yet run
+    await queue.put(('straggler',), {})
+    await asyncio.sleep(0.01, loop=event_loop)
+    assert queue.hedged == 0
+
+    queue.close()
+
+
+@pytest.mark.asyncio
+async def test_timed_out_call_is_sampled(event_loop, fake_client):
+    pool = WorkerPool()
+    pool.add(fake_client('stuck'))
+    queue = TaskQueue(FakeTask(), pool, loop=event_loop)
+
+    result = await queue.put(('stuck',), {}, timeout=0.01)
+    with pytest.raises(asyncio.TimeoutError):
+        await result
+
+    await asyncio.sleep(0, loop=event_loop)
+    assert len(queue.latency) == 1 and queue.latency.samples[0] >= 0.005
+
+    queue.close()
+
+
+@pytest.mark.asyncio
+async def test_released_call_restarts_elsewhere(event_loop, fake_client):
+    busy, idle = fake_client('busy', capacity=1), fake_client('idle', capacity=1)
+    pool = WorkerPool()
+    pool.add(busy)
+    queue = TaskQueue(FakeTask(), pool, retries=1, loop=event_loop)
+
+    result = await queue.put(('stolen',), {})
+    await asyncio.sleep(0, loop=event_loop)
+
+    pool.add(idle)
+    busy.finish(exception=WorkReleasedException())
+    await asyncio.sleep(0, loop=event_loop)
+    await asyncio.sleep(0, loop=event_loop)
+
+    assert idle.finish('done') == ('stolen',)
+    assert await result == 'done'
+
+    queue.close()
+
+
+@pytest.mark.asyncio
+async def test_released_call_goes_to_its_thief(event_loop, fake_client):
+    victim = fake_client('victim', capacity=1)
+    others = [fake_client(i) for i in range(9)]
+    pool = WorkerPool(choices=2)
+    pool.add(victim)
+    queue = TaskQueue(FakeTask(), pool, loop=event_loop)
+
+    result = await queue.put(('stolen',), {})
+    await asyncio.sleep(0, loop=event_loop)
+    for client in others:
+        pool.add(client)
+    thief, full = others[0], others[1]
+    full.set_in_flight(full.capacity)
+
+    victim.finish(exception=WorkReleasedException(thief))
+    await asyncio.sleep(0, loop=event_loop)
+    assert thief.finish('done') == ('stolen',)
+    assert await result == 'done'
+
+    # A thief without a free slot left by now leaves the call to the queue
+    await queue.put(('released',), {})
+    await asyncio.sleep(0, loop=event_loop)
+    victim, = [client for client in pool if client.work]
+    victim.finish(exception=WorkReleasedException(full))
+    await asyncio.sleep(0, loop=event_loop)
+    await asyncio.sleep(0, loop=event_loop)
+    assert not full.work and [args for client in pool for args, _ in client.work] == [('released',)]
+
+    queue.close()
+
+
+@pytest.mark.asyncio
+async def test_call_with_uploads_is_sent_once(event_loop, fake_client):
+    first, second = fake_client('first', capacity=2), fake_client('second', capacity=2)
+    pool = WorkerPool()
+    pool.add(first)
+    pool.add(second)
+    task = FakeTask()
+    task.hedge = 0.5
+    queue = TaskQueue(task, pool, loop=event_loop)
+    for _ in range(20):
+        queue.latency.add(0.001)
+
+    released = await queue.put((Upload(b'data'),), {})
+    lost = await queue.put((), {'data': Upload(b'data')})
+    await asyncio.sleep(0.01, loop=event_loop)
+    assert len(first.work) + len(second.work) == 2
+
+    first.finish(exception=WorkReleasedException())
+    second.finish(exception=ClientDisconnectedException())
+    await asyncio.sleep(0, loop=event_loop)
+
+    for result in (released, lost):
+        with pytest.raises(Exception, match="Aborting task"):
+            await result
+    assert not first.work and not second.work
+
+    queue.close()
+
+
+def test_hash_ring_moves_few_keys(fake_client):
+    clients = [fake_client(i) for i in range(10)]
+    ring = HashRing()
+    for client in clients:
+        ring.add(client)
+
+    def owners():
+        return [next(ring.walk(affinity_hash(key))) for key in range(1000)]
+
+    before = owners()
+    assert len(set(before)) == 10
+
+    ring.remove(clients[3])
+    after = owners()
+    moved = [key for key in range(1000) if before[key] is not after[key]]
+    assert all(before[key] is clients[3] for key in moved)
+
+    ring.add(clients[3])
+    assert owners() == before
+
+    # The same worker reconnecting from another address
+    reconnected = fake_client('elsewhere')
+    reconnected.identity = clients[3].identity
+    ring.remove(clients[3])
+    ring.add(reconnected)
+    assert [reconnected if owner is clients[3] else owner for owner in before] == owners()
+
+
+@pytest.mark.asyncio
+async def test_affinity_routing_with_bounded_load(event_loop, fake_client):
+    clients = [fake_client(i, capacity=1) for i in range(4)]
+    pool = WorkerPool()
+    for client in clients:
+        pool.add(client)
+
+    task = FakeTask()
+    task.affinity = lambda customer, item: customer
+    queue = TaskQueue(task, pool, loop=event_loop)
+
+    preferred = pool.route(affinity_hash('customer'))
+    assert preferred is pool.route(affinity_hash('customer'))
+
+    await queue.put(('customer', 1), {})
+    await queue.put(('customer', 2), {})
+    await asyncio.sleep(0, loop=event_loop)
+
+    assert [args for args, _ in preferred.work] == [('customer', 1)]
+    others = [args for client in clients if client is not preferred for args, _ in client.work]
+    assert others == [('customer', 2)]
+
+    queue.close()
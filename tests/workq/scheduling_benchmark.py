@@ -0,0 +1,37 @@
+import random
+import time
+
+from workq.orchestrator.scheduling import WorkerPool
+
+WORKERS = 1000
+DISPATCHES = 100000
+
+
+def test_dispatch_1k_workers(fake_client):
+    clients = [fake_client(i, capacity=DISPATCHES) for i in range(WORKERS)]
+    pool = WorkerPool()
+
+    start = time.perf_counter()
+    for client in clients:
+        pool.add(client)
+    registration = time.perf_counter() - start
+
+    # Keep every worker busy, with one in ten dispatches completing a random task
+    start = time.perf_counter()
+    for i in range(DISPATCHES):
+        worker = pool.select()
+        worker.set_in_flight(worker.in_flight + 1)
+
+        if i % 10 == 0:
+            done = random.choice(clients)
+            if done.in_flight > 0:
+                done.set_in_flight(done.in_flight - 1)
+    dispatch = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for client in clients:
+        pool.remove(client)
+    removal = time.perf_counter() - start
+
+    print(f"\n{WORKERS} workers: {WORKERS / registration:.0f} registrations/s, {DISPATCHES / dispatch:.0f} dispatches/s, "
+          f"{WORKERS / removal:.0f} removals/s")
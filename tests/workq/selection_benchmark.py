@@ -0,0 +1,94 @@
+import heapq
+import random
+from collections import deque
+
+from workq.orchestrator.client import SMOOTHING
+from workq.orchestrator.scheduling import WorkerPool
+
+FAST_WORKERS = 12
+SLOW_WORKERS = 4
+CAPACITY = 4
+# Mean service times, in arbitrary units
+FAST, SLOW = 1.0, 8.0
+CALLS = 50000
+UTILIZATION = 0.5
+
+
+def simulate(pool, clients, speeds, seed=0):
+    """
+    Run `CALLS` calls arriving at random through `pool`, with each client taking an exponentially distributed time to
+    complete a call. Calls wait in line while every client is saturated.
+    :return: The latencies of the calls, from arrival to completion.
+    """
+    rng = random.Random(seed)
+    pool.random.seed(seed)
+
+    throughput = sum(CAPACITY / speeds[client] for client in clients)
+    arrival_rate = UTILIZATION * throughput
+
+    now = 0.0
+    events = []
+    sequence = 0
+    for i in range(CALLS):
+        now += rng.expovariate(arrival_rate)
+        heapq.heappush(events, (now, sequence, 'arrival', None, now))
+        sequence += 1
+
+    waiting = deque()
+    latencies = []
+
+    def dispatch(client, arrived):
+        nonlocal sequence
+        client.set_in_flight(client.in_flight + 1)
+        done = now + rng.expovariate(1 / speeds[client])
+        heapq.heappush(events, (done, sequence, 'done', client, (arrived, now)))
+        sequence += 1
+
+    while events:
+        now, _, kind, client, data = heapq.heappop(events)
+
+        if kind == 'arrival':
+            client = pool.select()
+            if client is None:
+                waiting.append(data)
+            else:
+                dispatch(client, data)
+        else:
+            arrived, started = data
+            latencies.append(now - arrived)
+            sample = now - started
+            if client.service_time is None:
+                client.service_time = sample
+            else:
+                client.service_time += SMOOTHING * (sample - client.service_time)
+            client.set_in_flight(client.in_flight - 1)
+
+            if waiting:
+                dispatch(pool.select(), waiting.popleft())
+
+    return sorted(latencies)
+
+
+def p99(latencies):
+    return latencies[int(0.99 * len(latencies))]
+
+
+def run(fake_client, choices):
+    clients = [fake_client(i, capacity=CAPACITY) for i in range(FAST_WORKERS + SLOW_WORKERS)]
+    speeds = {client: FAST if i < FAST_WORKERS else SLOW for i, client in enumerate(clients)}
+
+    pool = WorkerPool(choices=choices)
+    for client in clients:
+        pool.add(client)
+
+    return simulate(pool, clients, speeds)
+
+
+def test_power_of_two_choices_heterogeneous_workers(fake_client):
+    least_loaded = run(fake_client, None)
+    two_choices = run(fake_client, 2)
+
+    print(f"\n{FAST_WORKERS} fast and {SLOW_WORKERS} {SLOW / FAST:.0f}x slower workers, p99 latency: "
+          f"least loaded {p99(least_loaded):.2f}, two choices {p99(two_choices):.2f}")
+
+    assert p99(two_choices) < p99(least_loaded)
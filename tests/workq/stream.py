@@ -2,6 +2,9 @@ import asyncio
 
 import pytest
 
+from workq.apickle.protocol5 import PickleBuffer
+from workq.net.messages import Message, Types, Flags, HEADER, ping, start_work
+
 
 @pytest.mark.asyncio
 async def test_readline(streampair, event_loop):
@@ -34,8 +37,8 @@ async def test_many_separate_streams(event_loop, streampair_generator, objects):
     for obj, streampair in zip(objects, streampair_generator):
         r, w = streampair
 
-        write_task = asyncio.ensure_future(w.send(obj), loop=event_loop)
-        assert obj == await r.decode()
+        write_task = asyncio.ensure_future(w.send(Message(Types.WORK_COMPLETE, payload=obj)), loop=event_loop)
+        assert obj == (await r.decode()).payload
         await write_task
 
 
@@ -44,6 +47,126 @@ async def test_many_same_stream(event_loop, streampair, objects):
     r, w = streampair
 
     for obj in objects:
-        write_task = asyncio.ensure_future(w.send(obj), loop=event_loop)
-        assert obj == await r.decode()
+        write_task = asyncio.ensure_future(w.send(Message(Types.WORK_COMPLETE, payload=obj)), loop=event_loop)
+        assert obj == (await r.decode()).payload
+        await write_task
+
+
+@pytest.mark.asyncio
+async def test_many_same_stream_streamed(event_loop, streampair, objects):
+    r, w = streampair
+
+    for obj in objects:
+        write_task = asyncio.ensure_future(w.send(Message(Types.WORK_COMPLETE, payload=obj), materialize=False), loop=event_loop)
+        assert obj == (await r.decode()).payload
+        await write_task
+
+
+@pytest.mark.skipif(PickleBuffer is None, reason="Pickle protocol 5 requires Python 3.8")
+@pytest.mark.asyncio
+async def test_out_of_band_buffers(event_loop, streampair):
+    r, w = streampair
+    w.oob_threshold = 1024
+
+    payload = bytes(range(256)) * 64
+    message = {
+        'bytearray': PickleBuffer(bytearray(payload)),
+        'memoryview': memoryview(bytearray(payload)).cast('i'),
+        'bytes': PickleBuffer(payload),
+        'small': bytearray(b'in-band'),
+    }
+
+    for max_frame_size in (1024 * 1024, 0):
+        r.max_frame_size = max_frame_size
+
+        write_task = asyncio.ensure_future(w.send(Message(Types.WORK_COMPLETE, payload=message)), loop=event_loop)
+        result = (await r.decode()).payload
+        await write_task
+
+        assert result['bytearray'] == payload
+        assert isinstance(result['bytearray'], bytearray)
+        assert result['memoryview'].format == 'i'
+        assert result['memoryview'] == message['memoryview']
+        assert result['bytes'] == payload
+        assert result['bytes'].readonly
+        assert result['small'] == message['small']
+
+
+@pytest.mark.asyncio
+async def test_binary_arguments_keep_their_type(event_loop, streampair):
+    r, w = streampair
+    data = bytes(range(256)) * 1024
+
+    write_task = asyncio.ensure_future(w.send(start_work(1, 1, (data, bytearray(data)), {'small': b'small'})),
+                                       loop=event_loop)
+    received = await r.decode()
+    await write_task
+
+    (binary, mutable), kwargs, _ = received.payload
+    assert type(binary) is bytes and binary == data
+    assert type(mutable) is bytearray and mutable == data
+    assert kwargs == {'small': b'small'}
+    if PickleBuffer is not None:
+        assert received.flags & Flags.OUT_OF_BAND
+
+
+@pytest.mark.parametrize('materialize', [True, False])
+@pytest.mark.asyncio
+async def test_cancelled_send_finishes_its_frame(event_loop, streampair, materialize):
+    r, w = streampair
+    data = bytes(8 * 1024 * 1024)
+
+    sending = asyncio.ensure_future(w.send(Message(Types.WORK_COMPLETE, payload=data), materialize), loop=event_loop)
+    await asyncio.sleep(0.01, loop=event_loop)
+    assert not sending.done()  # Blocked on the full socket buffer, partway through the frame
+    sending.cancel()
+
+    after = asyncio.ensure_future(w.send(ping), loop=event_loop)
+    assert (await asyncio.wait_for(r.decode(), 5, loop=event_loop)).payload == data
+    assert (await asyncio.wait_for(r.decode(), 5, loop=event_loop)).type == Types.PING
+    await after
+    with pytest.raises(asyncio.CancelledError):
+        await sending
+
+
+@pytest.mark.asyncio
+async def test_envelope(event_loop, streampair):
+    r, w = streampair
+
+    sent = Message(Types.DO_WORK, Flags.ERROR, work_id=42, task_id=7, payload=((1, 2), {}))
+    write_task = asyncio.ensure_future(w.send(sent), loop=event_loop)
+    received = await r.decode()
+    await write_task
+
+    assert (received.type, received.work_id, received.task_id) == (Types.DO_WORK, 42, 7)
+    assert received.error
+    assert received.encoded_payload is not None
+    assert received.payload == ((1, 2), {})
+
+
+@pytest.mark.asyncio
+async def test_ping_is_header_only(event_loop, streampair):
+    r, w = streampair
+
+    write_task = asyncio.ensure_future(w.send(ping), loop=event_loop)
+    header = await r.read_exactly(HEADER.size)
+    await write_task
+
+    assert HEADER.unpack(header)[0] == Types.PING
+    with pytest.raises(BlockingIOError):
+        r.sock.recv(1)
+
+
+@pytest.mark.asyncio
+async def test_forward_without_decoding(event_loop, streampair_generator, objects):
+    r1, w1 = next(streampair_generator)
+    r2, w2 = next(streampair_generator)
+
+    for obj in objects:
+        write_task = asyncio.ensure_future(w1.send(Message(Types.WORK_COMPLETE, payload=obj)), loop=event_loop)
+        forwarded = await r1.decode()
+        await write_task
+
+        write_task = asyncio.ensure_future(w2.send(forwarded), loop=event_loop)
+        assert obj == (await r2.decode()).payload
         await write_task
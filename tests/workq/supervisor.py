@@ -0,0 +1,68 @@
+import asyncio
+import os
+import signal
+import threading
+import time
+
+from workq.worker.supervisor import Supervisor, rss, RECYCLE
+
+
+class FakeWorker:
+    def __init__(self, runs):
+        self.runs = runs
+
+
+def test_worn_out_after_max_tasks():
+    supervisor = Supervisor('localhost', 0, processes=1, max_tasks=10)
+
+    assert not supervisor.worn_out(FakeWorker(9))
+    assert supervisor.worn_out(FakeWorker(10))
+
+
+def test_worn_out_above_max_rss():
+    assert rss() > 0
+    assert Supervisor('localhost', 0, processes=1, max_rss=1).worn_out(FakeWorker(0))
+    assert not Supervisor('localhost', 0, processes=1, max_rss=rss() * 4).worn_out(FakeWorker(0))
+
+
+class ScriptedSupervisor(Supervisor):
+    """Supervises forked workers that exit with the statuses in `script` in turn, by index, instead of joining a server."""
+
+    def __init__(self, script, **options):
+        super().__init__('localhost', 0, processes=len(script), restart_delay=0, **options)
+        self.script = script
+        self.started = []
+
+    def start(self, index):
+        self.started.append(index)  # Seen by the forked worker
+        super().start(index)
+
+    async def serve(self, index):
+        status = self.script[index][self.started.count(index) - 1]
+        if status is None:
+            await asyncio.sleep(60)
+        elif status == 'crash':
+            raise RuntimeError("Worker crashed")
+
+        return status
+
+
+def test_recycled_and_crashed_workers_are_restarted():
+    supervisor = ScriptedSupervisor([[RECYCLE, 0], ['crash', 'crash', 0], [0]])
+    supervisor.run()
+
+    assert sorted(supervisor.started) == [0, 0, 1, 1, 1, 2]
+    assert not supervisor.children
+
+
+def test_terminating_stops_the_workers():
+    supervisor = ScriptedSupervisor([[None], [None]])
+    threading.Timer(0.5, os.kill, (os.getpid(), signal.SIGTERM)).start()
+
+    handler = signal.getsignal(signal.SIGTERM)
+    started = time.monotonic()
+    supervisor.run()
+
+    assert time.monotonic() - started < 10
+    assert supervisor.started == [0, 1] and supervisor.stopping
+    assert signal.getsignal(signal.SIGTERM) is handler
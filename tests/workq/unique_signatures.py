@@ -46,4 +46,8 @@ def test_same_task_different_interfaces(interface1, interface2):
     interface1.task(test2)
     interface2.task(test2)
 
-    assert interface1.test2.signature != interface2.test2.signature
\ No newline at end of file
+    assert interface1.test2.signature != interface2.test2.signature
+
+
+def test_task_signature_is_cached(interface1):
+    assert interface1.test.signature is interface1.test.signature
@@ -0,0 +1,459 @@
+import asyncio
+import io
+import time
+
+import pytest
+
+from workq.interface import Interface
+from workq.net.messages import Flags, Types, STREAM_WINDOW, OOB_THRESHOLD, Message, start_work, start_batch, steal_work, cancel_work, \
+    grant_credit, upload_chunk
+from workq.net.stream import encode
+from workq.net.upload import Upload, UploadRef
+from workq.worker import Orchestrator
+
+
+def squared(x):
+    return x * x
+
+
+class FakeStream:
+    def __init__(self, tasks):
+        self.tasks = tasks
+        self.running = {}
+        self.pending = set()
+        self.credits = {}
+        self.uploads = {}
+        self.completed = 0
+        self.report = None
+        self.sent = []
+
+    async def send(self, msg, materialize=True):
+        self.sent.append(msg)
+
+
+@pytest.fixture
+def stream():
+    interface = Interface("worker")
+
+    @interface.task
+    def add(a, b):
+        pass
+
+    @interface.task
+    def count(n):
+        pass
+
+    @interface.task
+    def size(data):
+        pass
+
+    @interface.task
+    def square(x):
+        pass
+
+    @interface.task
+    def negate(x):
+        pass
+
+    @interface.add.implement
+    async def add(a, b):
+        return a + b
+
+    @interface.count.implement
+    async def count(n):
+        for i in range(n):
+            yield i
+
+    @interface.size.implement
+    async def size(data):
+        total = 0
+        async for chunk in data:
+            total += len(chunk)
+        return total
+
+    interface.square.implement(squared, executor='process')
+    interface.negate.implement(lambda x: -x, executor='thread')
+
+    return FakeStream({1: interface.add, 2: interface.count, 3: interface.size, 4: interface.square,
+                       5: interface.negate})
+
+
+@pytest.mark.asyncio
+async def test_pending_work_can_be_stolen(stream):
+    orchestrator = Orchestrator('localhost', 0)
+    stream.pending.update([1, 2])
+
+    await orchestrator.steal(stream, steal_work(1))
+    await orchestrator.work(stream, start_work(1, 1, (1, 2), {}))
+    await orchestrator.work(stream, start_work(2, 1, (2, 3), {}))
+    await orchestrator.steal(stream, steal_work(2))
+
+    released, result, refused = stream.sent
+    assert (released.type, released.work_id, released.payload) == (Types.RELEASE, 1, True)
+    assert (result.type, result.work_id, result.payload) == (Types.WORK_COMPLETE, 2, 5)
+    assert (refused.type, refused.work_id, refused.payload) == (Types.RELEASE, 2, False)
+
+
+@pytest.mark.asyncio
+async def test_pending_work_can_be_cancelled(stream):
+    orchestrator = Orchestrator('localhost', 0)
+    stream.pending.add(1)
+
+    await orchestrator.cancel(stream, cancel_work(1))
+    await orchestrator.work(stream, start_work(1, 1, (1, 2), {}))
+
+    cancelled, = stream.sent
+    assert cancelled.type == Types.WORK_COMPLETE and cancelled.error
+
+
+@pytest.mark.asyncio
+async def test_unreadable_work_fails(stream):
+    orchestrator = Orchestrator('localhost', 0)
+    stream.pending.update([1, 2, 3])
+    missing = b'cno_such_module\nthing\n.'
+
+    await orchestrator.work(stream, Message.encoded(Types.DO_WORK, 0, 1, 1, missing))
+    await orchestrator.work_batch(stream, Message.encoded(Types.DO_BATCH, 0, 2, 1, missing))
+    await orchestrator.work(stream, start_work(3, 99, (), {}))
+
+    assert [(msg.type, msg.work_id, msg.error) for msg in stream.sent] == [(Types.WORK_COMPLETE, 1, True),
+                                                                          (Types.WORK_COMPLETE, 2, True),
+                                                                          (Types.WORK_COMPLETE, 3, True)]
+    assert 'no_such_module' in stream.sent[0].payload
+    assert not stream.pending
+
+
+@pytest.mark.asyncio
+async def test_streamed_result_waits_for_credit(event_loop, stream):
+    orchestrator = Orchestrator('localhost', 0)
+    stream.pending.add(1)
+
+    work = asyncio.ensure_future(orchestrator.work(stream, start_work(1, 2, (STREAM_WINDOW + 4,), {})),
+                                 loop=event_loop)
+    await asyncio.sleep(0.01, loop=event_loop)
+    assert [msg.payload for msg in stream.sent] == list(range(STREAM_WINDOW))
+
+    await orchestrator.credit(stream, grant_credit(1, 4))
+    await work
+
+    *items, end = stream.sent
+    assert [msg.payload for msg in items] == list(range(STREAM_WINDOW + 4))
+    assert all(msg.type == Types.WORK_ITEM for msg in items)
+    assert end.type == Types.WORK_COMPLETE and not end.error
+    assert not stream.credits
+
+
+@pytest.mark.asyncio
+async def test_streamed_result_may_be_empty(stream):
+    orchestrator = Orchestrator('localhost', 0)
+    stream.pending.add(1)
+
+    await orchestrator.work(stream, start_work(1, 2, (0,), {}))
+
+    end, = stream.sent
+    assert end.type == Types.WORK_COMPLETE and end.flags & Flags.ITEMS and not end.error
+
+
+@pytest.mark.asyncio
+async def test_upload_is_read_while_it_is_sent(event_loop, stream):
+    orchestrator = Orchestrator('localhost', 0)
+    stream.pending.add(1)
+
+    work = asyncio.ensure_future(orchestrator.work(stream, start_work(1, 3, (UploadRef(7),), {})), loop=event_loop)
+    await asyncio.sleep(0, loop=event_loop)
+    for _ in range(STREAM_WINDOW):
+        await orchestrator.data(stream, upload_chunk(7, b'x' * 10))
+    await asyncio.sleep(0.01, loop=event_loop)
+
+    # The work takes the chunks as they arrive, and asks for more in halves of the window
+    grants = [msg for msg in stream.sent if msg.type == Types.CREDIT]
+    assert [(msg.work_id, msg.payload) for msg in grants] == [(7, STREAM_WINDOW // 2)] * 2
+
+    await orchestrator.data(stream, upload_chunk(7, None))
+    await work
+
+    result = stream.sent[-1]
+    assert (result.type, result.work_id, result.payload) == (Types.WORK_COMPLETE, 1, STREAM_WINDOW * 10)
+    assert not stream.uploads
+
+
+@pytest.mark.asyncio
+async def test_upload_chunks_its_source():
+    async def chunks(upload):
+        return [bytes(chunk) async for chunk in upload]
+
+    assert await chunks(Upload(b'abcdefg', chunk_size=3)) == [b'abc', b'def', b'g']
+    assert await chunks(Upload(io.BytesIO(b'abcdefg'), chunk_size=4)) == [b'abcd', b'efg']
+    assert await chunks(Upload([b'ab', b'cd'])) == [b'ab', b'cd']
+
+
+@pytest.mark.asyncio
+async def test_upload_of_bytes_is_sent(event_loop, streampair):
+    r, w = streampair
+    source = bytes(range(256)) * 1000
+
+    async def send():
+        async for chunk in Upload(source, chunk_size=OOB_THRESHOLD + 1000):
+            await w.send(upload_chunk(1, chunk))
+        await w.send(upload_chunk(1, b'x' * 100))
+
+    async def receive():
+        received = bytearray()
+        for _ in range(5):
+            chunk = (await r.decode()).payload
+            assert type(chunk) is bytes
+            received.extend(chunk)
+        return received
+
+    sent, received = await asyncio.wait_for(asyncio.gather(send(), receive(), loop=event_loop), 1, loop=event_loop)
+
+    assert received == source + b'x' * 100
+
+
+@pytest.mark.asyncio
+async def test_detached_work_is_reported_together(event_loop, stream):
+    orchestrator = Orchestrator('localhost', 0, capacity=8)
+    works = [start_work(i, 1, (i, 1), {}, detached=True) for i in range(6)]
+    stream.pending.update(work.work_id for work in works)
+
+    for work in works[:5]:
+        await orchestrator.work(stream, work)
+    await asyncio.sleep(0.05, loop=event_loop)
+    await orchestrator.work(stream, works[5])
+    await asyncio.sleep(0.05, loop=event_loop)
+
+    # Half the capacity completing reports at once, the rest after a short delay
+    assert [(msg.type, msg.payload) for msg in stream.sent] == [(Types.COMPLETED, 4), (Types.COMPLETED, 1),
+                                                                 (Types.COMPLETED, 1)]
+    assert works[0].flags & Flags.DETACHED
+
+
+@pytest.mark.asyncio
+async def test_process_pool_takes_encoded_payload(stream):
+    orchestrator = Orchestrator('localhost', 0, processes=1)
+    stream.pending.update([1, 2])
+
+    received = [Message.encoded(Types.DO_WORK, 0, 1, 4, *encode(((3,), {}, None))),
+                Message.encoded(Types.DO_BATCH, 0, 2, 4, *encode(([(1,), ('a',)], None)))]
+    await orchestrator.work(stream, received[0])
+    await orchestrator.work_batch(stream, received[1])
+    orchestrator.executors['process'].shutdown()
+
+    # Never unpickled on the worker
+    assert all(msg.encoded_payload is not None for msg in received)
+    result, batch = stream.sent
+    assert result.encoded_payload is not None and result.payload == 9
+    assert batch.payload[0] == (True, 1) and not batch.payload[1][0]
+
+
+@pytest.mark.asyncio
+async def test_plain_functions_run_inline_or_in_threads(stream):
+    orchestrator = Orchestrator('localhost', 0)
+    stream.pending.update([1, 2])
+    stream.tasks[6] = stream.tasks[5].member_of.add
+    stream.tasks[6].implement(lambda a, b: a + b)
+
+    await orchestrator.work(stream, start_work(1, 5, (3,), {}))
+    await orchestrator.work_batch(stream, start_batch(2, 6, [(1, 2), (1, None)]))
+    orchestrator.executors['thread'].shutdown()
+
+    result, batch = stream.sent
+    assert result.payload == -3
+    assert batch.payload[0] == (True, 3) and not batch.payload[1][0]
+
+
+@pytest.mark.asyncio
+async def test_timed_out_thread_keeps_its_slot(event_loop):
+    interface = Interface("sleeping")
+
+    @interface.task
+    def nap(seconds):
+        pass
+
+    @interface.nap.implement(executor='thread')
+    def nap(seconds):
+        time.sleep(seconds)
+
+    orchestrator = Orchestrator('localhost', 0, capacity=1)
+    stream = FakeStream({1: interface.nap})
+    stream.pending.add(1)
+
+    started = time.monotonic()
+    work = asyncio.ensure_future(orchestrator.work(stream, start_work(1, 1, (0.2,), {}, timeout=0.01)),
+                                 loop=event_loop)
+    await asyncio.sleep(0.1, loop=event_loop)
+
+    # Reported as failed, but the thread still sleeps in its slot
+    failed, = stream.sent
+    assert failed.error and orchestrator.slots.locked()
+
+    await work
+    assert time.monotonic() - started >= 0.2 and not orchestrator.slots.locked()
+    orchestrator.executors['thread'].shutdown()
+
+
+@pytest.mark.asyncio
+async def test_prefetched_work_waits_for_a_slot(event_loop, stream):
+    orchestrator = Orchestrator('localhost', 0, capacity=1, prefetch=2)
+    stream.pending.update([1, 2])
+    await orchestrator.slots.acquire()  # Taken by work already running
+
+    waiting = [asyncio.ensure_future(orchestrator.work(stream, start_work(i, 1, (i, 1), {})), loop=event_loop)
+               for i in (1, 2)]
+    await asyncio.sleep(0, loop=event_loop)
+    assert not stream.sent
+
+    # Until it starts, waiting work can still be stolen
+    await orchestrator.steal(stream, steal_work(2))
+    orchestrator.slots.release()
+    await asyncio.gather(*waiting, loop=event_loop)
+
+    released, result = stream.sent
+    assert (released.type, released.work_id, released.payload) == (Types.RELEASE, 2, True)
+    assert (result.type, result.work_id, result.payload) == (Types.WORK_COMPLETE, 1, 2)
+
+
+@pytest.mark.asyncio
+async def test_task_concurrency_limit(event_loop):
+    interface = Interface("limited")
+    running, peak = [], []
+
+    @interface.task
+    def step(i):
+        pass
+
+    @interface.step.implement(concurrency=2)
+    async def step(i):
+        running.append(i)
+        peak.append(len(running))
+        await asyncio.sleep(0.01, loop=event_loop)
+        running.remove(i)
+        return i
+
+    orchestrator = Orchestrator('localhost', 0, capacity=8)
+    stream = FakeStream({1: interface.step})
+    stream.pending.update(range(6))
+
+    await asyncio.gather(*[orchestrator.work(stream, start_work(i, 1, (i,), {})) for i in range(6)], loop=event_loop)
+
+    assert sorted(msg.payload for msg in stream.sent) == list(range(6))
+    assert max(peak) == 2
+
+
+@pytest.mark.asyncio
+async def test_draining_gives_back_new_work(event_loop, stream):
+    orchestrator = Orchestrator('localhost', 0)
+    stream.pending.update([1, 2])
+
+    drained = asyncio.ensure_future(orchestrator.drain(stream), loop=event_loop)
+    await asyncio.sleep(0, loop=event_loop)
+    await orchestrator.work(stream, start_work(1, 1, (1, 2), {}))
+    await orchestrator.work(stream, start_work(2, 1, (2, 3), {}, detached=True))
+    await asyncio.wait_for(drained, 1, loop=event_loop)
+
+    leaving, released, completed = stream.sent
+    assert leaving.type == Types.LEAVE
+    assert (released.type, released.work_id, released.payload) == (Types.RELEASE, 1, True)
+    assert (completed.type, completed.payload) == (Types.COMPLETED, 1)
+    assert orchestrator.runs == 1
+
+
+@pytest.mark.asyncio
+async def test_ping_measures_round_trip_time(event_loop, worker_streampair):
+    stream, server = worker_streampair
+    receiver = stream.listen(lambda msg: None)
+
+    async def echo():
+        await server.send(await server.decode())
+
+    asyncio.ensure_future(echo(), loop=event_loop)
+    rtt = await stream.ping(timeout=1)
+    assert rtt is not None and stream.rtt == rtt
+
+    assert await stream.ping(timeout=0.05) is None
+    assert stream.rtt == rtt
+    receiver.cancel()
+
+
+@pytest.mark.asyncio
+async def test_unpicklable_result_fails(event_loop, worker_streampair):
+    interface = Interface("results")
+
+    @interface.task
+    def function():
+        pass
+
+    @interface.function.implement
+    async def function():
+        return lambda: None
+
+    orchestrator = Orchestrator('localhost', 0)
+    stream, server = worker_streampair
+    stream.tasks[1] = interface.function
+    stream.pending.add(1)
+
+    await orchestrator.work(stream, start_work(1, 1, (), {}))
+    done = await asyncio.wait_for(server.decode(), 5, loop=event_loop)
+    assert done.type == Types.WORK_COMPLETE and done.error and 'pickle' in done.payload
+
+
+@pytest.mark.parametrize('deadline', [None, 0.05])
+@pytest.mark.asyncio
+async def test_work_cancelled_while_sending_an_item(event_loop, worker_streampair, deadline):
+    interface = Interface("items")
+
+    @interface.task
+    def chunks():
+        pass
+
+    @interface.chunks.implement
+    async def chunks():
+        while True:
+            yield bytes(8 * 1024 * 1024)
+
+    orchestrator = Orchestrator('localhost', 0)
+    stream, server = worker_streampair
+    stream.tasks[1] = interface.chunks
+    stream.pending.add(1)
+
+    work = asyncio.ensure_future(orchestrator.work(stream, start_work(1, 1, (), {}, deadline)), loop=event_loop)
+    await asyncio.sleep(0.1, loop=event_loop)  # Blocked partway through the first item, or timed out there
+    if deadline is None:
+        await orchestrator.cancel(stream, cancel_work(1))
+
+    item = await asyncio.wait_for(server.decode(), 5, loop=event_loop)
+    assert item.type == Types.WORK_ITEM and len(item.payload) == 8 * 1024 * 1024
+    done = await asyncio.wait_for(server.decode(), 5, loop=event_loop)
+    assert done.type == Types.WORK_COMPLETE and done.error and done.flags & Flags.ITEMS
+    await work
+
+
+@pytest.mark.asyncio
+async def test_keepalive_pings_only_quiet_connections(event_loop, worker_streampair):
+    orchestrator = Orchestrator('localhost', 0, keepalive_every=0.2)
+    stream, server = worker_streampair
+    receiver = stream.listen(lambda msg: None)
+    aborted = asyncio.Event(loop=event_loop)
+    stream.abort = aborted.set
+    pings = []
+
+    async def record():
+        while True:
+            pings.append(await server.decode())
+
+    async def traffic(seconds):
+        for _ in range(int(seconds / 0.01)):
+            await server.send(Message(Types.PING, flags=Flags.PROBE))
+            await asyncio.sleep(0.01, loop=event_loop)
+
+    recorder = asyncio.ensure_future(record(), loop=event_loop)
+    keepalive = asyncio.ensure_future(orchestrator._keepalive(stream), loop=event_loop)
+    await traffic(0.6)
+    assert not pings
+
+    # The server went silent, and does not answer pings either
+    await asyncio.wait_for(aborted.wait(), 5, loop=event_loop)
+    assert pings and all(ping.type == Types.PING for ping in pings)
+
+    for task in (keepalive, recorder, receiver):
+        task.cancel()
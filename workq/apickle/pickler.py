@@ -1,4 +1,5 @@
 import codecs
+import io
 import sys
 from copyreg import dispatch_table
 from functools import partial
@@ -8,17 +9,56 @@ from pickle import PyStringMap, FunctionType, DEFAULT_PROTOCOL, HIGHEST_PROTOCOL
     NEWTRUE, TRUE, NEWFALSE, FALSE, BININT1, BININT2, BININT, encode_long, LONG1, LONG4, LONG, BINFLOAT, FLOAT, \
     SHORT_BINBYTES, BINBYTES8, BINBYTES, SHORT_BINUNICODE, BINUNICODE8, BINUNICODE, UNICODE, EMPTY_TUPLE, MARK, TUPLE, \
     POP_MARK, EMPTY_LIST, LIST, APPEND, APPENDS, EMPTY_DICT, DICT, SETITEM, SETITEMS, EMPTY_SET, ADDITEMS, FROZENSET, \
-    whichmodule, GLOBAL, EXT1, STACK_GLOBAL, EXT4, EXT2
-from pickle import _compat_pickle, _getattribute, _Framer, _tuplesize2code, _extension_registry
+    whichmodule, GLOBAL, EXT1, STACK_GLOBAL, EXT4, EXT2, FRAME
+from pickle import _compat_pickle, _getattribute, _tuplesize2code, _extension_registry
 from struct import pack
 
+from .protocol5 import PickleBuffer, BYTEARRAY8, NEXT_BUFFER, READONLY_BUFFER
 
-async def dump(obj, file, protocol=None, *, fix_imports=True):
-    await Pickler(file, protocol, fix_imports=fix_imports).dump(obj)
+
+async def dump(obj, file, protocol=None, *, fix_imports=True, buffer_callback=None):
+    await Pickler(file, protocol, fix_imports=fix_imports, buffer_callback=buffer_callback).dump(obj)
+
+
+class _Framer:
+    """Async counterpart of pickle._Framer, batching protocol 4 opcodes into frames before they reach the file."""
+
+    _FRAME_SIZE_MIN = 4
+    _FRAME_SIZE_TARGET = 64 * 1024
+
+    def __init__(self, file_write):
+        self.file_write = file_write
+        self.current_frame = None
+
+    def start_framing(self):
+        self.current_frame = io.BytesIO()
+
+    async def end_framing(self):
+        if self.current_frame and self.current_frame.tell() > 0:
+            await self.commit_frame(force=True)
+            self.current_frame = None
+
+    async def commit_frame(self, force=False):
+        if self.current_frame:
+            f = self.current_frame
+            if f.tell() >= self._FRAME_SIZE_TARGET or force:
+                data = f.getvalue()
+                write = self.file_write
+                if len(data) >= self._FRAME_SIZE_MIN:
+                    await write(FRAME + pack("<Q", len(data)) + data)
+                else:
+                    await write(data)
+                self.current_frame = io.BytesIO()
+
+    async def write(self, data):
+        if self.current_frame:
+            self.current_frame.write(data)
+        else:
+            await self.file_write(data)
 
 
 class Pickler:
-    def __init__(self, file, protocol=None, *, fix_imports=True):
+    def __init__(self, file, protocol=None, *, fix_imports=True, buffer_callback=None):
         """This takes a binary file for writing a pickle data stream.
         The optional *protocol* argument tells the pickler to use the
         given protocol; supported protocols are 0, 1, 2, 3 and 4.  The
@@ -36,6 +76,10 @@ class Pickler:
         will try to map the new Python 3 names to the old module names
         used in Python 2, so that the pickle data stream is readable
         with Python 2.
+        If *buffer_callback* is not None, it is called with every
+        PickleBuffer met during pickling. A false return value means the
+        buffer is serialized out-of-band, and the caller is responsible
+        for transmitting it alongside the pickle. Requires protocol 5.
         """
         if protocol is None:
             protocol = DEFAULT_PROTOCOL
@@ -43,6 +87,9 @@ class Pickler:
             protocol = HIGHEST_PROTOCOL
         elif not 0 <= protocol <= HIGHEST_PROTOCOL:
             raise ValueError("pickle protocol must be <= %d" % HIGHEST_PROTOCOL)
+        if buffer_callback is not None and protocol < 5:
+            raise ValueError("buffer_callback needs protocol >= 5")
+        self._buffer_callback = buffer_callback
         try:
             self._file_write = file.write
         except AttributeError:
@@ -77,7 +124,7 @@ class Pickler:
             self.framer.start_framing()
         await self.save(obj)
         await self.write(STOP)
-        self.framer.end_framing()
+        await self.framer.end_framing()
 
     async def memoize(self, obj):
         """Store an object in the memo."""
@@ -124,7 +171,7 @@ class Pickler:
         return GET + repr(i).encode("ascii") + b'\n'
 
     async def save(self, obj, save_persistent_id=True):
-        self.framer.commit_frame()
+        await self.framer.commit_frame()
 
         # Check for persistent id (defined by a subclass)
         pid = self.persistent_id(obj)
@@ -376,6 +423,44 @@ class Pickler:
 
     dispatch[bytes] = save_bytes
 
+    async def save_bytearray(self, obj):
+        if self.proto < 5:
+            if not obj:  # bytearray is empty
+                await self.save_reduce(bytearray, (), obj=obj)
+            else:
+                await self.save_reduce(bytearray, (bytes(obj),), obj=obj)
+            return
+        n = len(obj)
+        await self.write(BYTEARRAY8 + pack("<Q", n) + obj)
+
+    dispatch[bytearray] = save_bytearray
+
+    if PickleBuffer is not None:
+        async def save_picklebuffer(self, obj):
+            if self.proto < 5:
+                raise PicklingError("PickleBuffer can only pickled with "
+                                    "protocol >= 5")
+            with obj.raw() as m:
+                if not m.contiguous:
+                    raise PicklingError("PickleBuffer can not be pickled when "
+                                        "pointing to a non-contiguous buffer")
+                in_band = True
+                if self._buffer_callback is not None:
+                    in_band = bool(self._buffer_callback(obj))
+                if in_band:
+                    # Write data in-band
+                    if m.readonly:
+                        await self.save_bytes(m.tobytes())
+                    else:
+                        await self.save_bytearray(m.tobytes())
+                else:
+                    # Write data out-of-band
+                    await self.write(NEXT_BUFFER)
+                    if m.readonly:
+                        await self.write(READONLY_BUFFER)
+
+        dispatch[PickleBuffer] = save_picklebuffer
+
     async def save_str(self, obj):
         if self.bin:
             encoded = obj.encode('utf-8', 'surrogatepass')
@@ -0,0 +1,9 @@
+# Pickle protocol 5 (PEP 574) support. PickleBuffer and the new opcodes are only exported by pickle from Python 3.8.
+try:
+    from pickle import PickleBuffer
+except ImportError:
+    PickleBuffer = None
+
+BYTEARRAY8 = b'\x96'  # push bytearray
+NEXT_BUFFER = b'\x97'  # push next out-of-band buffer
+READONLY_BUFFER = b'\x98'  # make top of stack readonly
@@ -1,7 +1,8 @@
 import codecs
+import io
 import sys
 
-from pickle import _Unframer, _Stop, _extension_cache, _inverted_registry, _compat_pickle, _getattribute, bytes_types, \
+from pickle import _Stop, _extension_cache, _inverted_registry, _compat_pickle, _getattribute, bytes_types, \
     UnpicklingError, FRAME, HIGHEST_PROTOCOL, PROTO, STOP, MEMOIZE, \
     BINPUT, LONG_BINPUT, PUT, BINGET, LONG_BINGET, GET, BINPERSID, PERSID, NEWOBJ_EX, REDUCE, NEWOBJ, POP, BUILD, NONE, \
     NEWTRUE, TRUE, NEWFALSE, FALSE, BININT1, BININT2, BININT, LONG1, LONG4, LONG, BINFLOAT, FLOAT, \
@@ -12,15 +13,58 @@ from pickle import _Unframer, _Stop, _extension_cache, _inverted_registry, _comp
 from struct import unpack
 from sys import maxsize
 
+from .protocol5 import BYTEARRAY8, NEXT_BUFFER, READONLY_BUFFER
 
-def load(afile, *, fix_imports=True, encoding="ASCII", errors="strict"):
+
+def load(afile, *, fix_imports=True, encoding="ASCII", errors="strict", buffers=None):
     return Unpickler(afile, fix_imports=fix_imports,
-                     encoding=encoding, errors=errors).load()
+                     encoding=encoding, errors=errors, buffers=buffers).load()
+
+
+class _Unframer:
+    """Async counterpart of pickle._Unframer. A protocol 4 frame is read from the file in one go."""
+
+    def __init__(self, file_read, file_readline):
+        self.file_read = file_read
+        self.file_readline = file_readline
+        self.current_frame = None
+
+    async def read(self, n):
+        if self.current_frame:
+            data = self.current_frame.read(n)
+            if not data and n != 0:
+                self.current_frame = None
+                return await self.file_read(n)
+            if len(data) < n:
+                raise UnpicklingError(
+                    "pickle exhausted before end of frame")
+            return data
+        else:
+            return await self.file_read(n)
+
+    async def readline(self):
+        if self.current_frame:
+            data = self.current_frame.readline()
+            if not data:
+                self.current_frame = None
+                return await self.file_readline()
+            if data[-1] != b'\n'[0]:
+                raise UnpicklingError(
+                    "pickle exhausted before end of frame")
+            return data
+        else:
+            return await self.file_readline()
+
+    async def load_frame(self, frame_size):
+        if self.current_frame and self.current_frame.read() != b'':
+            raise UnpicklingError(
+                "beginning of a new frame before end of current frame")
+        self.current_frame = io.BytesIO(await self.file_read(frame_size))
 
 
 class Unpickler:
     def __init__(self, file, *, fix_imports=True,
-                 encoding="ASCII", errors="strict"):
+                 encoding="ASCII", errors="strict", buffers=None):
         """This takes a binary file for reading a pickle data stream.
         The protocol version of the pickle is detected automatically, so
         no proto argument is needed.
@@ -43,9 +87,13 @@ class Unpickler:
         to decode 8-bit string instances pickled by Python 2; these
         default to 'ASCII' and 'strict', respectively. *encoding* can be
         'bytes' to read theses 8-bit string instances as bytes objects.
+        If *buffers* is not None, it should be an iterable of buffer-enabled
+        objects that is consumed each time the pickle stream references
+        an out-of-band buffer.
         """
         self._file_readline = file.readline
         self._file_read = file.read
+        self._buffers = iter(buffers) if buffers is not None else None
         self.memo = {}
         self.encoding = encoding
         self.errors = errors
@@ -104,7 +152,7 @@ class Unpickler:
         frame_size, = unpack('<Q', await self.read(8))
         if frame_size > sys.maxsize:
             raise ValueError("frame size > sys.maxsize: %d" % frame_size)
-        self._unframer.load_frame(frame_size)
+        await self._unframer.load_frame(frame_size)
 
     dispatch[FRAME[0]] = load_frame
 
@@ -272,6 +320,35 @@ class Unpickler:
 
     dispatch[BINBYTES8[0]] = load_binbytes8
 
+    async def load_bytearray8(self):
+        len, = unpack('<Q', await self.read(8))
+        if len > maxsize:
+            raise UnpicklingError("BYTEARRAY8 exceeds system's maximum size "
+                                  "of %d bytes" % maxsize)
+        self.append(bytearray(await self.read(len)))
+
+    dispatch[BYTEARRAY8[0]] = load_bytearray8
+
+    async def load_next_buffer(self):
+        if self._buffers is None:
+            raise UnpicklingError("pickle stream refers to out-of-band data "
+                                  "but no *buffers* argument was given")
+        try:
+            buf = next(self._buffers)
+        except StopIteration:
+            raise UnpicklingError("not enough out-of-band buffers")
+        self.append(buf)
+
+    dispatch[NEXT_BUFFER[0]] = load_next_buffer
+
+    async def load_readonly_buffer(self):
+        buf = self.stack[-1]
+        with memoryview(buf) as m:
+            if not m.readonly:
+                self.stack[-1] = m.toreadonly()
+
+    dispatch[READONLY_BUFFER[0]] = load_readonly_buffer
+
     async def load_short_binstring(self):
         len = (await self.read(1))[0]
         data = await self.read(len)
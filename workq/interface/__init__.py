@@ -11,14 +11,31 @@ class Interface(Signature):
         self.tasks = {}
         self.server = None
 
-    def task(self, fn):
-        task = Task(fn.__name__, signature(fn), self)
+    def task(self, fn=None, *, cache=None, coalesce=False, hedge=None, affinity=None):
+        """
+        Declare a task of this interface, as a decorator on a function with the task's signature.
+        :param cache: Serve the results of repeated calls with the same arguments from a cache on the orchestrator, for
+        tasks that are pure functions of their arguments. True for a cache with default settings, or a dict of keyword
+        arguments to `orchestrator.cache.ResultCache`.
+        :param coalesce: While a call is in flight, have calls with the same arguments and priority wait for its result,
+        instead of running the task again. Each caller waits until its own timeout, and the call is cancelled once all
+        of them gave up.
+        :param hedge: A percentile of the task's latency, e.g. 0.95. Calls still running for longer are started again on
+        another worker, and the first result is used.
+        :param affinity: A function with the task's signature, returning a key for its arguments. Calls with the same key
+        are sent to the same worker, for as long as it has a free slot and the workers do not change.
+        """
+        if fn is None:
+            return lambda fn: self.task(fn, cache=cache, coalesce=coalesce, hedge=hedge, affinity=affinity)
+
+        task = Task(fn.__name__, signature(fn), self, cache=cache, coalesce=coalesce, hedge=hedge, affinity=affinity)
 
         sig = task.signature
         assert sig not in self.tasks, "Task with same signature already exists in this cion_interface."
 
         self.tasks[sig] = task
         setattr(self, task.name, task)
+        self.invalidate_signature()
 
     def signature_generator(self):
         # The cion_interface name is included in each cion_interface signature, so to need to yield it here
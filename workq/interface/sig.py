@@ -2,14 +2,23 @@ import hashlib
 
 
 class Signature:
+    _signature = None
+
     @property
     def signature(self):
-        m = hashlib.md5()
+        # Computed once, signature_generator only changes through `invalidate_signature`
+        if self._signature is None:
+            m = hashlib.md5()
+
+            for sig in self.signature_generator():
+                m.update(sig)
+
+            self._signature = m.hexdigest()
 
-        for sig in self.signature_generator():
-            m.update(sig)
+        return self._signature
 
-        return m.hexdigest()
+    def invalidate_signature(self):
+        self._signature = None
 
     def signature_generator(self):
         raise NotImplementedError()
\ No newline at end of file
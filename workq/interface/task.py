@@ -1,13 +1,21 @@
-from inspect import signature
+from concurrent.futures import Executor
+from functools import partial
+from inspect import signature, iscoroutinefunction, isasyncgenfunction
 
 from .sig import Signature
 
 
 class Task(Signature):
-    def __init__(self, name, signature, interface):
+    def __init__(self, name, signature, interface, cache=None, coalesce=False, hedge=None, affinity=None):
         self.name = name
         self.member_of = interface
         self.implementation = None
+        self.executor = None
+        self.concurrency = None
+        self.cache = cache
+        self.coalesce = coalesce
+        self.hedge = hedge
+        self.affinity = affinity
 
         self.args = signature.parameters
 
@@ -29,13 +37,100 @@ class Task(Signature):
         for self_param, other_param in zip(self.args.values(), other_args.values()):
             assert self_param.kind == other_param.kind, f"Expected parameter {self_param}, but got {other_param}"
 
-    def implement(self, fn):
+    def implement(self, fn=None, *, executor=None, concurrency=None):
+        """
+        Implement this task with `fn`, a coroutine function, an async generator function, or a plain function.
+        :param executor: Where the worker runs a plain function: 'thread' or 'process' for its thread or process pool, or
+        a `concurrent.futures.Executor`. By default it is called on the event loop, which suits only quick functions.
+        Functions run in a process pool must be picklable, i.e. defined at the top level of a module. A call that times
+        out or is cancelled fails right away, but as a thread or process can't be interrupted, the function runs on, and
+        keeps its slot on the worker until it returns.
+        :param concurrency: The number of calls to this task a worker runs at once. Further calls sent to the worker wait
+        there for one to finish, and may be stolen by idle workers in the meantime.
+        :return: `fn`, so it stays available under its name.
+        """
+        if fn is None:
+            return partial(self.implement, executor=executor, concurrency=concurrency)
+
         self.valid_implementation_guard(fn)
+        assert executor in (None, 'thread', 'process') or isinstance(executor, Executor), \
+            f"Unknown executor {executor!r}"
+        assert executor is None or not (iscoroutinefunction(fn) or isasyncgenfunction(fn)), \
+            "Only plain functions can run in an executor"
+        assert concurrency is None or concurrency > 0, "Concurrency must be at least one call"
 
         self.implementation = fn
+        self.executor = executor
+        self.concurrency = concurrency
+        return fn
+
+    def __call__(self, *args, **kwargs):
+        return self.options()(*args, **kwargs)
+
+    def submit(self, *args, **kwargs):
+        """
+        Queue a call to this task, waiting for room in its queue first if the workers are falling behind.
+        :return: A coroutine, resolving to a future for the result once the call is queued.
+        """
+        return self.options().submit(*args, **kwargs)
+
+    def submit_nowait(self, *args, **kwargs):
+        """
+        Queue a call to this task without waiting for it to run, or for its result.
+        :raises asyncio.QueueFull: If the workers are falling behind, and the queue of this task is full.
+        """
+        self.options().submit_nowait(*args, **kwargs)
+
+    def map(self, iterable, chunksize=64, ordered=True):
+        return self.options().map(iterable, chunksize, ordered)
+
+    def starmap(self, iterable, chunksize=64, ordered=True):
+        return self.options().starmap(iterable, chunksize, ordered)
+
+    def options(self, **options):
+        """
+        :param priority: Calls with a higher priority are handed to the workers first, when they are all busy.
+        :param timeout: Seconds after which a call fails with `asyncio.TimeoutError`, and its worker stops working on it.
+        For `map`, the timeout applies to each batch of calls.
+        :return: This task, to be called with the given options, e.g. `interface.task.options(priority=1)(arg)`.
+        """
+        return TaskOptions(self, options)
+
+
+class TaskOptions:
+    def __init__(self, task, options):
+        self.task = task
+        self.options = options
+
+    @property
+    def server(self):
+        assert self.task.member_of.server is not None, "Interface not enabled"
+        return self.task.member_of.server
 
     def __call__(self, *args, **kwargs):
+        """
+        :return: A coroutine for the result of the call. If the task is implemented as an async generator, the result is
+        an async iterator over the items it yields, see `net.flow.ItemStream`. Large binary arguments can be streamed to
+        the worker by passing them as a `net.upload.Upload`.
+        """
         # assert self.valid_args(args, kwargs), "Invalid arguments"
 
-        assert self.member_of.server is not None, "Interface not enabled"
-        return self.member_of.server.start_task(self, args, kwargs)
+        return self.server.start_task(self.task, args, kwargs, **self.options)
+
+    def submit(self, *args, **kwargs):
+        return self.server.submit(self.task, args, kwargs, **self.options)
+
+    def submit_nowait(self, *args, **kwargs):
+        self.server.submit_nowait(self.task, args, kwargs, **self.options)
+
+    def map(self, iterable, chunksize=64, ordered=True):
+        """
+        Call this task with each item of `iterable` as its argument. Calls are sent to the workers `chunksize` at a time.
+        :param ordered: Yield the results in the order of `iterable`, or else as they complete.
+        :return: An async iterator over the results.
+        """
+        return self.server.map_task(self.task, ((item,) for item in iterable), chunksize, ordered, **self.options)
+
+    def starmap(self, iterable, chunksize=64, ordered=True):
+        """Like `map`, but each item of `iterable` is a tuple of arguments to the task."""
+        return self.server.map_task(self.task, map(tuple, iterable), chunksize, ordered, **self.options)
@@ -0,0 +1,81 @@
+import asyncio
+from collections import deque
+
+from .messages import STREAM_WINDOW
+
+
+class ItemStream:
+    """
+    Items streamed by the other side of a connection, as an async iterator. The sender may run at most `STREAM_WINDOW`
+    items ahead of those taken from the stream, so only that many are held in memory here. More are asked for by calling
+    `grant` with the number of items taken. Closing the stream before it ends calls `cancel`, as does dropping it, e.g. by
+    breaking out of an `async for` over it. It can also be used as an async context manager, which closes it on exit.
+    """
+
+    def __init__(self, grant, cancel=None):
+        self.grant = grant
+        self.cancel = cancel
+        self.items = deque()
+        self.taken = 0
+        self.done = False
+        self.exception = None
+        self.waiter = None
+
+    def __aiter__(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    async def __anext__(self):
+        while not self.items:
+            if self.done:
+                if self.exception is not None:
+                    raise self.exception
+
+                raise StopAsyncIteration
+
+            self.waiter = asyncio.get_event_loop().create_future()
+            await self.waiter
+
+        item = self.items.popleft()
+
+        # Credit is granted in halves of the window, so the sender rarely has to wait for it
+        self.taken += 1
+        if self.taken >= STREAM_WINDOW // 2 and not self.done:
+            self.grant(self.taken)
+            self.taken = 0
+
+        return item
+
+    def put(self, item):
+        self.items.append(item)
+        self._wake()
+
+    def finish(self, exception=None):
+        if not self.done:
+            self.done = True
+            self.exception = exception
+            self._wake()
+
+    def close(self):
+        if not self.done:
+            if self.cancel is not None:
+                self.cancel()
+            self.finish()
+
+        self.items.clear()
+
+    async def aclose(self):
+        self.close()
+
+    def __del__(self):
+        if not self.done and self.cancel is not None:
+            self.cancel()
+
+    def _wake(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
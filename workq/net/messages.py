@@ -1,71 +1,252 @@
+import pickle
+from struct import Struct
+
+from ..apickle.protocol5 import PickleBuffer
+
+# Binary task arguments and results of at least this many bytes are sent outside the pickle stream, see `out_of_band`.
+OOB_THRESHOLD = 64 * 1024
+
+# Every message starts with a fixed envelope: type, flags, work id, task id and the length of the pickled payload.
+HEADER = Struct('<BBIHI')
+MAX_PAYLOAD_LENGTH = 0xffffffff
+# Task ids are assigned per connection when a worker announces its interfaces, see `Client.supports`
+NO_TASK = 0
+MAX_TASK_ID = 0xffff
+# Number of items of a streamed result the worker may send before the server grants it more credit
+STREAM_WINDOW = 16
+
+
 class Types:
     SUPPORTS = 0
     RESPONSE = 1
     DO_WORK = 2
     WORK_COMPLETE = 3
     PING = 4
+    DO_BATCH = 5
+    CANCEL = 6
+    STEAL = 7
+    RELEASE = 8
+    WORK_ITEM = 9
+    CREDIT = 10
+    DATA = 11
+    COMPLETED = 12
+    LEAVE = 13
+
+    all = [SUPPORTS, RESPONSE, DO_WORK, WORK_COMPLETE, PING, DO_BATCH, CANCEL, STEAL, RELEASE, WORK_ITEM, CREDIT, DATA,
+           COMPLETED, LEAVE]
+
+
+class Flags:
+    ERROR = 0x01  # The payload is an error message or a traceback
+    PROBE = 0x02  # A ping from the server measuring the round trip time, echoed by the worker
+    DETACHED = 0x04  # Work whose outcome is not reported, only counted in a COMPLETED message
+    ITEMS = 0x08  # Ends a result streamed in WORK_ITEM messages, of which there may have been none
+    UPLOADS = 0x10  # Work with `UploadRef` arguments, whose uploads follow it
+
+    # Set by the stream when writing the message
+    STREAMED = 0x40  # The payload was streamed by the async pickler, so its length is not known up front
+    OUT_OF_BAND = 0x80  # Out-of-band buffers follow the envelope
+
+    wire = STREAMED | OUT_OF_BAND
+
+
+class Message:
+    """
+    A message as sent on the wire: an envelope, and an optional payload. Received payloads are only unpickled when they
+    are first accessed, so messages can be routed, forwarded or discarded on the envelope alone.
+    """
+    __slots__ = ('type', 'flags', 'work_id', 'task_id', '_payload', '_encoded')
+
+    def __init__(self, type, flags=0, work_id=0, task_id=NO_TASK, payload=None):
+        self.type = type
+        self.flags = flags
+        self.work_id = work_id
+        self.task_id = task_id
+        self._payload = payload
+        self._encoded = None
+
+    @classmethod
+    def encoded(cls, type, flags, work_id, task_id, data, buffers=None):
+        message = cls(type, flags, work_id, task_id)
+        message._encoded = data, buffers
+        return message
 
-    all = [SUPPORTS, RESPONSE, DO_WORK, WORK_COMPLETE, PING]
+    @property
+    def payload(self):
+        if self._encoded is not None:
+            data, buffers = self._encoded
 
+            if not buffers:
+                self._payload = pickle.loads(data)
+            else:
+                self._payload = pickle.loads(data, buffers=buffers)
 
-class Keys:
-    WORK_ID = 'w'
-    WORK_RESULT = 'r'
-    WORK_EXC = 'x'
-    KWARGS = 'd'
-    ARGS = 'a'
-    TASK = 'T'
-    TYPE = "t"
-    INTERFACE = 'i'
-    ERROR = 'e'
-    MSG = 'm'
+            self._encoded = None
 
+        return self._payload
 
-ping = { Keys.TYPE: Types.PING }
+    @payload.setter
+    def payload(self, value):
+        self._encoded = None
+        self._payload = value
+
+    @property
+    def encoded_payload(self):
+        """The received, still pickled payload as a (data, buffers) tuple, or None if there is none."""
+        return self._encoded
+
+    @property
+    def error(self):
+        return bool(self.flags & Flags.ERROR)
+
+    def pack_header(self, flags, length):
+        return HEADER.pack(self.type, (self.flags & ~Flags.wire) | flags, self.work_id, self.task_id, length)
+
+    def __repr__(self):
+        return f"Message(type={self.type}, flags={self.flags:#x}, work_id={self.work_id}, task_id={self.task_id})"
+
+
+ping = Message(Types.PING)
+probe = Message(Types.PING, Flags.PROBE)
+# Sent by a worker that is about to stop, so the server sends it no more work
+leave = Message(Types.LEAVE)
 
 
 def ok(**data):
-    return {Keys.TYPE: Types.RESPONSE, Keys.ERROR: False, **data}
+    return Message(Types.RESPONSE, payload=data or None)
 
 
 def error(msg):
-    return {Keys.TYPE: Types.RESPONSE, Keys.ERROR: True, Keys.MSG: msg}
+    return Message(Types.RESPONSE, Flags.ERROR, payload=msg)
+
+
+def supports_interface(interface, capacity, identity):
+    """:param identity: Names the worker across connections, see `Client.identity`."""
+    return Message(Types.SUPPORTS, payload=(interface.signature, capacity, identity))
+
+
+class OutOfBandBytes:
+    """
+    Pickles a bytes-like value as an out-of-band buffer, so it is written straight from its own memory, and rebuilds it
+    as bytes on the receiving side, copied once out of the receive buffer.
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __reduce_ex__(self, protocol):
+        return bytes, (PickleBuffer(self.value),)
+
 
+def out_of_band(value):
+    """
+    Wrap large bytes and bytearray values, so the stream writes them straight from their own memory instead of copying
+    them into the pickle. They arrive as the type they were sent as. Requires pickle protocol 5, otherwise `value` is
+    returned as is.
+    """
+    if PickleBuffer is None or type(value) not in (bytes, bytearray) or len(value) < OOB_THRESHOLD:
+        return value
 
-def supports_interface(interface):
-    return {Keys.TYPE: Types.SUPPORTS, Keys.INTERFACE: interface.signature}
+    # A bytearray is received into a bytearray, while bytes would arrive as a read-only view of one
+    return PickleBuffer(value) if type(value) is bytearray else OutOfBandBytes(value)
 
 
-def start_work(work_id, task, args, kwargs):
-    return {
-        Keys.TYPE: Types.DO_WORK,
-        Keys.TASK: task.signature,
-        Keys.WORK_ID: work_id,
-        Keys.ARGS: args,
-        Keys.KWARGS: kwargs
-    }
+def start_work(work_id, task_id, args, kwargs, timeout=None, detached=False, uploads=False):
+    """
+    :param timeout: Seconds the worker has left to finish the work, or None for no deadline.
+    :param detached: Whether the worker only counts the work once it is done, see `detached_completed`.
+    :param uploads: Whether any of the arguments is an `UploadRef`.
+    """
+    args = tuple(map(out_of_band, args))
+    kwargs = {kw: out_of_band(value) for kw, value in kwargs.items()}
+    flags = (Flags.DETACHED if detached else 0) | (Flags.UPLOADS if uploads else 0)
+
+    return Message(Types.DO_WORK, flags, work_id=work_id, task_id=task_id, payload=(args, kwargs, timeout))
+
+
+def start_batch(work_id, task_id, arglist, timeout=None):
+    """Run a task once for every tuple of positional arguments in `arglist`, as one piece of work."""
+    arglist = [tuple(map(out_of_band, args)) for args in arglist]
+
+    return Message(Types.DO_BATCH, work_id=work_id, task_id=task_id, payload=(arglist, timeout))
+
+
+def cancel_work(work_id):
+    """Ask the worker to stop working on `work_id`. It answers with a failed WORK_COMPLETE, unless it finished first."""
+    return Message(Types.CANCEL, work_id=work_id)
+
+
+def steal_work(work_id):
+    """Ask the worker to give `work_id` back, if it has not started on it yet. It answers with `release_work`."""
+    return Message(Types.STEAL, work_id=work_id)
+
+
+def release_work(work_id, released):
+    """:param released: Whether the worker gave up `work_id` without starting it, so it can be started elsewhere."""
+    return Message(Types.RELEASE, work_id=work_id, payload=released)
+
+
+def work_item(work_id, item):
+    """One item of a result streamed by an async generator task. The stream ends with a WORK_COMPLETE flagged ITEMS."""
+    return Message(Types.WORK_ITEM, work_id=work_id, payload=out_of_band(item))
+
+
+def grant_credit(stream_id, items):
+    """
+    Allow the other side to send `items` more items of a stream: the result streamed for a work id by the worker, or an
+    upload to the worker by its upload id.
+    """
+    return Message(Types.CREDIT, work_id=stream_id, payload=items)
+
+
+def upload_chunk(upload_id, chunk):
+    """
+    A chunk of an `Upload` argument, carrying the upload id in the work id field. A None chunk ends the upload. Chunks
+    that are memoryviews, like those cut from a bytes-like source, arrive as bytes.
+    """
+    if type(chunk) is memoryview:
+        large = PickleBuffer is not None and chunk.nbytes >= OOB_THRESHOLD
+        chunk = OutOfBandBytes(chunk) if large else chunk.tobytes()
+
+    return Message(Types.DATA, work_id=upload_id, payload=out_of_band(chunk))
+
+
+def upload_failed(upload_id, exception):
+    """Ends an upload whose source raised `exception`, a traceback string."""
+    return Message(Types.DATA, Flags.ERROR, work_id=upload_id, payload=exception)
 
 
 def work_result(work_id, result):
-    return {
-        Keys.TYPE: Types.WORK_COMPLETE,
-        Keys.WORK_ID: work_id,
-        Keys.WORK_RESULT: result
-    }
+    return Message(Types.WORK_COMPLETE, work_id=work_id, payload=out_of_band(result))
+
+
+def encoded_result(work_id, encoded):
+    """Like `work_result`, for a result pickled already, see `net.stream.encode`."""
+    data, buffers = encoded
+    return Message.encoded(Types.WORK_COMPLETE, 0, work_id, NO_TASK, data, buffers)
+
+
+def batch_result(work_id, results):
+    """:param results: A (succeeded, result or traceback) tuple for each call in the batch, in order."""
+    results = [(succeeded, out_of_band(result)) for succeeded, result in results]
+
+    return Message(Types.WORK_COMPLETE, work_id=work_id, payload=results)
 
 
 def work_failed(work_id, exception):
-    return {
-        Keys.TYPE: Types.WORK_COMPLETE,
-        Keys.WORK_ID: work_id,
-        Keys.WORK_EXC: exception
-    }
+    return Message(Types.WORK_COMPLETE, Flags.ERROR, work_id=work_id, payload=exception)
+
+
+def detached_completed(count):
+    """Sent by the worker instead of a WORK_COMPLETE for each detached work, for `count` of them at once."""
+    return Message(Types.COMPLETED, payload=count)
 
 
 def error_guard(response):
-    assert response[Keys.TYPE] == Types.RESPONSE, "Expected response type"
-    assert not response[Keys.ERROR], response[Keys.MSG]
+    assert response.type == Types.RESPONSE, "Expected response type"
+    assert not response.error, response.payload
 
 
 def expect_guard(type, response):
-    assert response[Keys.TYPE] == type, f"Expected {type} type, but got {response[Keys.TYPE]}."
+    assert response.type == type, f"Expected {type} type, but got {response.type}."
@@ -1,15 +1,33 @@
 import asyncio
+import io
+import pickle
+import ssl
 from functools import partial
+from struct import Struct
 
 from workq import apickle
+from workq.apickle.protocol5 import PickleBuffer
 from .buffer import Buffer
+from .messages import OOB_THRESHOLD, HEADER, MAX_PAYLOAD_LENGTH, Flags, Message
 
 NEWLINE = b'\n'
 
+# Out-of-band buffers are announced by a flag in the message header. Their number and lengths follow the header, then
+# the raw buffers themselves, and finally the pickled payload.
+BUFFER_COUNT = Struct('<I')
+BUFFER_LENGTH = Struct('<Q')
+
+PROTOCOL = pickle.HIGHEST_PROTOCOL
+
+# Upper bound on the number of buffers passed to a single sendmsg call, the smallest IOV_MAX of the platforms we run on.
+IOV_MAX = 1024
+
 
 class Stream:
-    def __init__(self, sock, bufsize=4096, loop=asyncio.get_event_loop()):
+    def __init__(self, sock, bufsize=4096, max_frame_size=4 * 1024 * 1024, oob_threshold=OOB_THRESHOLD,
+                 loop=asyncio.get_event_loop()):
         self.sock = sock
+        self.loop = loop
         self._sock_recv = partial(loop.sock_recv, self.sock)
         self.read_lock = asyncio.Lock()
         self.write_lock = asyncio.Lock()
@@ -17,14 +35,135 @@ class Stream:
 
         self.buffer = Buffer(bufsize, loop)
         self.buffer_size = bufsize
+        self.max_frame_size = max_frame_size
+        self.oob_threshold = oob_threshold
+
+    async def send(self, message, materialize=True):
+        """
+        Send a `Message`. The C pickler serializes its payload into a single buffer, which is written together with the
+        header in one call to sendmsg. Binary payloads of at least `oob_threshold` bytes are not copied into the pickle,
+        but written straight from their own memory after the header (pickle protocol 5 only). A received message that
+        is sent on is written as it was received, without unpickling its payload.
+        Payloads too large to materialize in memory should be sent with `materialize=False`, which streams them through
+        the async pickler instead.
+        Once a message is partly written, it is written to the end, or every message after it would be misread. A send
+        cancelled by then only raises the CancelledError after that.
+        """
+        if not materialize:
+            with await self.write_lock:
+                return await _finished(asyncio.ensure_future(self._send_streamed(message), loop=self.loop))
+
+        buffers = None
+        encoded = message.encoded_payload
+        if encoded is not None:
+            data, buffers = encoded
+        elif message.payload is None:
+            data = b''
+        else:
+            frame = io.BytesIO()
+            buffers = _dump(message.payload, frame, self.oob_threshold)
+            data = frame.getbuffer()
+
+        flags = 0
+        parts = [data]
+
+        if buffers:
+            flags |= Flags.OUT_OF_BAND
+            raw = [PickleBuffer(buffer).raw() for buffer in buffers]
+            parts = [BUFFER_COUNT.pack(len(raw)), *(BUFFER_LENGTH.pack(m.nbytes) for m in raw), *raw, data]
+
+        length = len(data)
+        if length > MAX_PAYLOAD_LENGTH:
+            # Too long for the header, but a pickle marks its own end, so the receiver can read it as a streamed one
+            flags |= Flags.STREAMED
+            length = 0
+
+        parts.insert(0, message.pack_header(flags, length))
 
-    async def send(self, data):
         with await self.write_lock:
-            return await apickle.dump(data, self)
+            return await self._writev(parts)
+
+    async def _send_streamed(self, message):
+        await self.write(message.pack_header(Flags.STREAMED, 0))
+        return await apickle.dump(message.payload, self, protocol=PROTOCOL)
 
     async def decode(self):
+        """
+        Read one `Message` from the stream. Payloads up to `max_frame_size` bytes are read into a single buffer, and
+        handed to the C unpickler once the payload is accessed. Larger and streamed payloads are decoded opcode by
+        opcode straight off the socket. Out-of-band buffers are received directly into their final memory.
+        """
         with await self.read_lock:
-            return await apickle.load(self)
+            type, flags, work_id, task_id, length = HEADER.unpack(await self._read_exactly(HEADER.size))
+
+            buffers = None
+            if flags & Flags.OUT_OF_BAND:
+                num_buffers, = BUFFER_COUNT.unpack(await self._read_exactly(BUFFER_COUNT.size))
+                lengths = await self._read_exactly(BUFFER_LENGTH.size * num_buffers)
+                buffers = [await self._read_buffer(n) for n, in BUFFER_LENGTH.iter_unpack(lengths)]
+
+            if flags & Flags.STREAMED or length > self.max_frame_size:
+                payload = await apickle.load(self, buffers=buffers)
+                return Message(type, flags, work_id, task_id, payload)
+
+            if length == 0:
+                return Message(type, flags, work_id, task_id)
+
+            return Message.encoded(type, flags, work_id, task_id, await self._read_exactly(length), buffers)
+
+    async def _writev(self, parts):
+        """Write all `parts` in order, gathering them into as few sendmsg calls as possible instead of joining them."""
+        if isinstance(self.sock, ssl.SSLSocket):  # SSL sockets do not implement sendmsg
+            return await _finished(asyncio.ensure_future(self.write(b''.join(parts)), loop=self.loop))
+
+        views = [memoryview(part).cast('B') for part in parts]
+        views = [view for view in views if view.nbytes > 0]
+        cancelled = False
+        while views:
+            try:
+                sent = self.sock.sendmsg(views[:IOV_MAX])
+            except (BlockingIOError, InterruptedError):
+                try:
+                    await self._writable()
+                except asyncio.CancelledError:
+                    cancelled = True  # Raised once the rest of the frame is written
+                continue
+
+            while sent > 0:
+                head = views[0]
+                if sent >= head.nbytes:
+                    sent -= head.nbytes
+                    views.pop(0)
+                else:
+                    views[0] = head[sent:]
+                    sent = 0
+
+        if cancelled:
+            raise asyncio.CancelledError()
+
+    def _writable(self):
+        fd = self.sock.fileno()
+        future = self.loop.create_future()
+        self.loop.add_writer(fd, lambda: future.done() or future.set_result(None))
+        future.add_done_callback(lambda _: self.loop.remove_writer(fd))
+        return future
+
+    async def _read_buffer(self, n):
+        """Read exactly `n` bytes into a new bytearray, receiving straight into it once the read buffer is drained."""
+        result = bytearray(n)
+
+        with memoryview(result) as view:
+            read = min(n, self.buffer.read_available)
+            await self.buffer.read_into(view, read)
+
+            while read < n:
+                received = await self.loop.sock_recv_into(self.sock, view[read:])
+                if received == 0:
+                    raise EOFError
+
+                read += received
+
+        return result
 
     async def _read(self, n):
         if self.buffer.read_available > 0:
@@ -32,7 +171,7 @@ class Stream:
         else:
             return await self._sock_recv(n)
 
-    async def read_exactly(self, n):
+    async def _read_exactly(self, n):
         result = bytearray(n)
 
         read = 0
@@ -46,7 +185,10 @@ class Stream:
             read += length
 
         assert read == n
-        return bytes(result)
+        return result
+
+    async def read_exactly(self, n):
+        return bytes(await self._read_exactly(n))
 
     # Just for cPickle, because it expects f.read to always return exactly n bytes
     read = read_exactly
@@ -68,4 +210,82 @@ class Stream:
                 await buf_write(data[i+1:])
                 break
 
-        return bytes(result)
\ No newline at end of file
+        return bytes(result)
+
+
+class _Pickler(pickle.Pickler):
+    """
+    C pickler that sends PickleBuffers and C-contiguous memoryviews of at least `threshold` bytes out of band. bytes and
+    bytearray objects take the C pickler's in-band fast path, so they must be wrapped by the caller, see
+    `messages.out_of_band`. Out-of-band buffers arrive as bytearrays, or read-only memoryviews if the original was
+    read-only.
+    """
+
+    def __init__(self, file, threshold, buffers):
+        super().__init__(file, PROTOCOL, buffer_callback=self.buffer_callback)
+        self.threshold = threshold
+        self.buffers = buffers
+
+    def buffer_callback(self, buffer):
+        with buffer.raw() as m:
+            if m.nbytes < self.threshold:
+                return True
+
+        self.buffers.append(buffer)
+        return False
+
+    def reducer_override(self, obj):
+        if type(obj) is memoryview and obj.c_contiguous and obj.nbytes >= self.threshold:
+            return _rebuild_memoryview, (PickleBuffer(obj), obj.format, obj.shape)
+
+        return NotImplemented
+
+
+def _rebuild_memoryview(buffer, format, shape):
+    return memoryview(buffer).cast(format, shape)
+
+
+def _dump(data, file, oob_threshold):
+    """Pickle `data` into `file`, and return the buffers that were left out of band."""
+    if PickleBuffer is None:
+        pickle.dump(data, file, protocol=PROTOCOL)
+        return []
+
+    buffers = []
+    _Pickler(file, oob_threshold, buffers).dump(data)
+    return buffers
+
+
+def encode(payload, oob_threshold=OOB_THRESHOLD):
+    """
+    Pickle `payload` the way `Stream.send` does, to be sent later as the encoded payload of a `Message`, e.g. by another
+    process. Out-of-band buffers are copied into bytes, so the result can be pickled in turn.
+    :return: A (data, buffers) tuple.
+    """
+    frame = io.BytesIO()
+    buffers = _dump(payload, frame, oob_threshold)
+    return frame.getvalue(), [buffer.raw().tobytes() for buffer in buffers]
+
+
+def decode(encoded):
+    """Unpickle a (data, buffers) tuple, the inverse of `encode`."""
+    data, buffers = encoded
+    if not buffers:
+        return pickle.loads(data)
+
+    return pickle.loads(data, buffers=buffers)
+
+
+async def _finished(future):
+    """:return: The result of `future`, awaited to the end even if cancelled meanwhile, which is raised after that."""
+    cancelled = False
+    while not future.done():
+        try:
+            await asyncio.shield(future)
+        except asyncio.CancelledError:
+            cancelled = True
+
+    if cancelled:
+        raise asyncio.CancelledError()
+
+    return future.result()
@@ -0,0 +1,66 @@
+import asyncio
+
+# Size of the chunks read from files and binary values
+CHUNK_SIZE = 1024 * 1024
+
+
+class Upload:
+    """
+    A task argument streamed to the worker in chunks, instead of being pickled into the DO_WORK message. The source is
+    an async iterable or iterable of bytes-like chunks, a file-like object with a `read` method, or a bytes-like value.
+    On the worker the argument is an async iterator over the chunks, which can be consumed while the upload is still in
+    progress. Only top-level arguments can be uploads, and as the source is read once, a call with uploads is not hedged,
+    stolen or retried on another worker. It fails if its worker is lost.
+    """
+
+    def __init__(self, source, chunk_size=CHUNK_SIZE):
+        self.source = source
+        self.chunk_size = chunk_size
+
+    def __aiter__(self):
+        return self.chunks()
+
+    async def chunks(self):
+        source = self.source
+
+        if hasattr(source, 'read'):
+            loop = asyncio.get_event_loop()
+            while True:
+                # Files are read in the default executor, to keep disk reads off the event loop
+                chunk = await loop.run_in_executor(None, source.read, self.chunk_size)
+                if not chunk:
+                    return
+
+                yield chunk
+        elif hasattr(source, '__aiter__'):
+            async for chunk in source:
+                yield chunk
+        elif isinstance(source, (bytes, bytearray, memoryview)):
+            view = memoryview(source).cast('B')
+            for start in range(0, len(view), self.chunk_size):
+                # Sent without copying, see `upload_chunk`
+                yield view[start:start + self.chunk_size]
+        else:
+            for chunk in source:
+                yield chunk
+
+    def __reduce__(self):
+        raise TypeError("Uploads can only be passed as top-level task arguments.")
+
+
+class UploadRef:
+    """Stands in for an `Upload` in the DO_WORK message, by its id on the connection."""
+    __slots__ = ('upload_id',)
+
+    def __init__(self, upload_id):
+        self.upload_id = upload_id
+
+    def __reduce__(self):
+        return UploadRef, (self.upload_id,)
+
+
+class UploadException(Exception):
+    """Raised from an upload on the worker when reading its source failed on the server."""
+
+    def __init__(self, trace):
+        self.trace = trace
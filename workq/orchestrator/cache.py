@@ -0,0 +1,146 @@
+import hashlib
+import io
+import pickle
+import sys
+import time
+from collections import OrderedDict
+from functools import partial
+from itertools import islice
+
+# Items of a long container that its size is estimated from
+SIZE_SAMPLE = 16
+
+
+def arguments_key(args, kwargs):
+    """
+    :return: A hash of the pickle of `args` and `kwargs`, or None if they cannot be pickled and so cannot be hashed.
+    Dicts and sets are hashed in a canonical order, so equal ones hash the same. Inside other objects they are pickled
+    as they are, as is anything else, so equal values with different pickles, such as 1 and 1.0, hash differently.
+    """
+    try:
+        data = _pickle(_canonical((args, kwargs)))
+    except Exception:
+        return None
+
+    return hashlib.md5(data).digest()
+
+
+def _pickle(value):
+    data = io.BytesIO()
+    pickler = pickle.Pickler(data, protocol=pickle.HIGHEST_PROTOCOL)
+    # Without the memo, a value shared between arguments is pickled the same as an equal copy of it
+    pickler.fast = True
+    pickler.dump(value)
+    return data.getvalue()
+
+
+def _canonical(value):
+    """:return: `value` with the dicts and sets in it as tuples of their items, in the order of their pickles."""
+    kind = type(value)
+    if kind is dict:
+        return kind, _sorted((_canonical(key), _canonical(item)) for key, item in value.items())
+    if kind is set or kind is frozenset:
+        return kind, _sorted(_canonical(item) for item in value)
+    if kind is list or kind is tuple:
+        return kind, tuple(_canonical(item) for item in value)
+
+    return value
+
+
+_sorted = partial(sorted, key=_pickle)
+
+
+def estimate_size(value, depth=4):
+    """
+    :return: An estimate of the memory held by `value` in bytes, counting lists, tuples, sets and dicts `depth` levels
+    deep, and the attributes of objects. Long containers are estimated from their first `SIZE_SAMPLE` items, so this
+    is cheap however large `value` is.
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, memoryview):
+        return size + value.nbytes
+    if not depth:
+        return size
+
+    if isinstance(value, (list, tuple, set, frozenset, dict)):
+        if value:
+            items = value.items() if isinstance(value, dict) else value
+            sample = [estimate_size(item, depth - 1) for item in islice(items, SIZE_SAMPLE)]
+            size += sum(sample) * len(value) // len(sample)
+    elif hasattr(value, '__dict__'):
+        size += estimate_size(vars(value), depth - 1)
+
+    return size
+
+
+class ResultCache:
+    """
+    Results of a deterministic task by a hash of their arguments, evicted least recently used first once the cache holds
+    `maxsize` results or an estimated `max_bytes` bytes of them, see `estimate_size`. Results older than `ttl` seconds
+    are not served.
+
+    Hits are served as the very object that was cached, so cached results must not be mutated.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, max_bytes=64 * 1024 * 1024, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.clock = clock
+        # (expires, size, result) by key, least recently used first
+        self.entries = OrderedDict()
+        self.bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    key = staticmethod(arguments_key)
+
+    def get(self, key):
+        """:return: A (hit, result) tuple."""
+        try:
+            expires, size, result = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return False, None
+
+        if expires is not None and expires <= self.clock():
+            self._remove(key)
+            self.misses += 1
+            return False, None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return True, result
+
+    def put(self, key, result):
+        size = estimate_size(result)
+        if size > self.max_bytes:
+            return
+
+        if key in self.entries:
+            self._remove(key)
+
+        expires = None if self.ttl is None else self.clock() + self.ttl
+        self.entries[key] = expires, size, result
+        self.bytes += size
+
+        while len(self.entries) > self.maxsize or self.bytes > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions, size=len(self.entries),
+                    bytes=self.bytes)
+
+    def _remove(self, key):
+        _, size, _ = self.entries.pop(key)
+        self.bytes -= size
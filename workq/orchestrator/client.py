@@ -1,58 +1,348 @@
 import asyncio
+import traceback
+import weakref
 from enum import IntEnum, auto
-from uuid import uuid4
+from functools import partial
+from itertools import count
 
 from logzero import logger
 
-from ..net.messages import start_work, Keys
+from ..net.flow import ItemStream
+from ..net.messages import start_work, start_batch, cancel_work, steal_work, grant_credit, upload_chunk, \
+    upload_failed, probe, Flags, NO_TASK, MAX_TASK_ID, STREAM_WINDOW
+from ..net.upload import Upload, UploadRef
+
+# Weight of the newest sample in the moving averages of a client's latencies
+SMOOTHING = 0.2
 
 
 class Client:
-    def __init__(self, addr, port, stream):
+    def __init__(self, addr, port, stream, capacity=1):
         self.addr = addr
         self.port = port
         self.stream = stream
-        self.state = ClientState.IDLE
         self.futures = {}
+        # Tasks and start times of the work in flight, the clients work was asked back from this one for, and weak
+        # references to the results being streamed, by work id
+        self.work_tasks = {}
+        self.started = {}
+        self.stealing = {}
+        self.streams = {}
+        self.work_ids = count()
+        # Tasks sending the uploads of the work in flight by work id, and the chunks each upload may still send by
+        # upload id
+        self.work_uploads = {}
+        self.upload_credits = {}
+        self.upload_ids = count()
+        # Detached work sent to the client that it has not reported as completed yet
+        self.detached = 0
         self.supported_interfaces = []
+        self.task_ids = {}
+        self.pools = []
+        self.capacity = capacity
+        # Names the worker across connections, unlike the address of this one, so calls are routed to it by affinity
+        # after it reconnects as before
+        self.identity = self.name
 
-    async def start(self, task, args, kwargs):
-        self.state = ClientState.WORKING
+        # Exponentially weighted moving averages of the time from starting a call to its result, and of the round trip
+        # time of a ping, in seconds, once measured. Work that fails, is cancelled or streams its result is left out, and
+        # a batch counts as that many calls
+        self.service_time = None
+        self.rtt = None
+        self.probe_sent = None
 
-        work_id = str(uuid4())
-        self.futures[work_id] = asyncio.get_event_loop().create_future()
+    @property
+    def in_flight(self):
+        return len(self.futures) + self.detached
+
+    @property
+    def load(self):
+        return self.in_flight / self.capacity
+
+    @property
+    def state(self):
+        return ClientState.WORKING if self.in_flight else ClientState.IDLE
+
+    def load_changed(self):
+        """Re-index this client in its pools, after its load, or the amount of work it could give back, changed."""
+        for pool in self.pools:
+            pool.update(self)
+
+    def start(self, task, args, kwargs, timeout=None):
+        """
+        Take a slot on this client, and send it `task` to work on. The slot is taken before returning, while the work is
+        sent in the background. Cancelling the returned future cancels the work on the client, which frees the slot
+        once it confirms. Arguments that are an `Upload` are streamed after the work, so the client can start on it
+        before they are sent in full. As they can only be sent once, work with uploads is never stolen.
+        :param timeout: Seconds the client has to finish the work, after which it gives up on it.
+        :return: A future for the result of the work.
+        """
+        uploads = []
 
-        await self.stream.send(start_work(work_id, task, args, kwargs))
-        return await self.futures[work_id]
+        def reference(value):
+            if not isinstance(value, Upload):
+                return value
+
+            upload_id = next(self.upload_ids) & 0xffffffff
+            uploads.append((upload_id, value))
+            return UploadRef(upload_id)
+
+        args = tuple(reference(value) for value in args)
+        kwargs = {name: reference(value) for name, value in kwargs.items()}
+
+        return self._start(task, partial(start_work, task_id=self.task_ids[task], args=args, kwargs=kwargs,
+                                         timeout=timeout, uploads=bool(uploads)), uploads)
+
+    def start_batch(self, task, arglist, timeout=None):
+        """
+        Like `start`, but run `task` for each tuple of arguments in `arglist`, taking up a single slot.
+        :return: A future for a list of (succeeded, result or traceback) tuples, one for each call.
+        """
+        return self._start(task, partial(start_batch, task_id=self.task_ids[task], arglist=arglist, timeout=timeout),
+                           calls=len(arglist) or 1)
+
+    def start_detached(self, task, args, kwargs, timeout=None):
+        """
+        Like `start`, but the client does not report the outcome of the work, and there is no future for it. The work
+        takes up a slot until the client counts it as completed, see `completed`. It can't be cancelled or stolen, and
+        is lost if the connection is.
+        """
+        self.detached += 1
+        self.load_changed()
+
+        message = start_work(next(self.work_ids) & 0xffffffff, self.task_ids[task], args, kwargs, timeout, detached=True)
+        sending = asyncio.ensure_future(self.stream.send(message))
+        sending.add_done_callback(self.detached_sent)
+
+    def detached_sent(self, sending):
+        if sending.cancelled() or sending.exception() is None or isinstance(sending.exception(), OSError):
+            return
+
+        logger.error(f"Could not send detached work to {self.name}: {sending.exception()!r}")
+        self.detached -= 1
+        self.load_changed()
+
+    def completed(self, msg):
+        self.detached = max(0, self.detached - msg.payload)
+        self.load_changed()
+
+    def _start(self, task, message, uploads=(), calls=1):
+        # Work ids only need to be unique among the work in flight on this connection
+        work_id = next(self.work_ids) & 0xffffffff
+        loop = asyncio.get_event_loop()
+        future = self.futures[work_id] = loop.create_future()
+        self.work_tasks[work_id] = task
+        self.started[work_id] = loop.time(), calls
+
+        sending = asyncio.ensure_future(self.stream.send(message(work_id)), loop=loop)
+        sending.add_done_callback(partial(self.sent, work_id))
+        future.add_done_callback(partial(self.abandoned, work_id))
+
+        # Started after the work, so their first chunks are written after it
+        if uploads:
+            self.work_uploads[work_id] = [asyncio.ensure_future(self._upload(upload_id, upload), loop=loop)
+                                          for upload_id, upload in uploads]
+
+        self.load_changed()
+        return future
+
+    async def _upload(self, upload_id, upload):
+        """Send the chunks of `upload`, at most `STREAM_WINDOW` ahead of those the client has taken."""
+        credit = self.upload_credits[upload_id] = asyncio.Semaphore(STREAM_WINDOW)
+        try:
+            async for chunk in upload:
+                await credit.acquire()
+                await self.stream.send(upload_chunk(upload_id, chunk))
+
+            await self.stream.send(upload_chunk(upload_id, None))
+        except asyncio.CancelledError:
+            raise
+        except OSError:
+            pass  # The connection is lost, and with it the work
+        except Exception:
+            # Reading the source failed, which fails the work reading the upload on the client
+            logger.exception(f"Exception in upload {upload_id}.")
+            self._send_soon(upload_failed(upload_id, traceback.format_exc()))
+        finally:
+            del self.upload_credits[upload_id]
+
+    def credit(self, msg):
+        credit = self.upload_credits.get(msg.work_id)
+        if credit is not None:
+            for _ in range(msg.payload):
+                credit.release()
+
+    def abandoned(self, work_id, future):
+        if future.cancelled() and self.futures.get(work_id) is future:
+            self.cancel(work_id)
+
+    def cancel(self, work_id):
+        # Sent after the work itself, as sends are written in the order they were started
+        self._send_soon(cancel_work(work_id))
+
+    def grant(self, work_id, items):
+        self._send_soon(grant_credit(work_id, items))
+
+    def _send_soon(self, message):
+        # If the connection is lost, so is the work the message is about, so failures are left to the disconnect
+        sending = asyncio.ensure_future(self.stream.send(message))
+        sending.add_done_callback(lambda sending: sending.cancelled() or sending.exception())
+
+    def sent(self, work_id, sending):
+        if sending.cancelled() or sending.exception() is None:
+            return
+
+        if isinstance(sending.exception(), OSError):
+            return  # The connection is lost, and the work is failed over when the client is disconnected
+
+        # The work could not be serialized, so nothing reached the client. Free the slot again
+        future = self._pop(work_id)
+        if future is not None and not future.done():
+            future.set_exception(sending.exception())
 
     def supports(self, interface):
+        """
+        Register `interface` as supported by this client, and assign each of its tasks an id for this connection.
+        :return: The assigned ids by task signature, for the client to map DO_WORK messages back to its tasks.
+        """
         self.supported_interfaces.append(interface)
 
+        for task in interface.tasks.values():
+            if task not in self.task_ids:
+                task_id = NO_TASK + 1 + len(self.task_ids)
+                assert task_id <= MAX_TASK_ID, "Too many tasks on one connection."
+                self.task_ids[task] = task_id
+
+        return {task.signature: self.task_ids[task] for task in interface.tasks.values()}
+
+    def steal(self, interface, thief=None):
+        """
+        Ask the client to give back the most recently sent work for a task of `interface`, if it has not started on it.
+        The work fails with `WorkReleasedException` once the client agrees, so it can be started elsewhere.
+        :param thief: The client the work is asked back for, passed on with the exception.
+        :return: Whether there was any such work to ask for.
+        """
+        for work_id in reversed(list(self.work_tasks)):
+            if work_id in self.stealing or work_id in self.work_uploads:
+                continue
+
+            if self.work_tasks[work_id].member_of is interface:
+                self.stealing[work_id] = thief
+                self.load_changed()
+                self._send_soon(steal_work(work_id))
+                return True
+
+        return False
+
+    @property
+    def stealable(self):
+        """The amount of work in flight that has not been asked back yet, and could be."""
+        return len(self.futures) - len(self.stealing) - len(self.work_uploads)
+
+    def released(self, msg):
+        if not msg.payload:
+            # Already started
+            self.stealing.pop(msg.work_id, None)
+            self.load_changed()
+            return
+
+        thief = self.stealing.get(msg.work_id)
+        future = self._pop(msg.work_id)
+        if future is not None and not future.done():
+            future.set_exception(WorkReleasedException(thief))
+
+    def work_item(self, msg):
+        """
+        Add an item to the result being streamed for the work. The future of the work gets an `ItemStream` as its result
+        once the first item arrives, or the stream ends. Closing it cancels the work.
+        """
+        future = self.futures.get(msg.work_id)
+        if future is None or future.cancelled():
+            return  # Cancelled, and the client is being told to stop
+
+        stream = self.streams.get(msg.work_id)
+        stream = self._open_stream(msg.work_id, future) if stream is None else stream()
+        if stream is not None:  # Otherwise it was dropped, which cancelled the work
+            stream.put(msg.payload)
+
+    def _open_stream(self, work_id, future):
+        stream = ItemStream(partial(self.grant, work_id), partial(self.cancel, work_id))
+        # Nothing here keeps the stream alive, so dropping it cancels the work. That includes the future, which holds the
+        # stream as its result, so it is swapped for one standing in for the work until the stream ends
+        self.streams[work_id] = weakref.ref(stream)
+        self.futures[work_id] = asyncio.get_event_loop().create_future()
+        future.set_result(stream)
+        return stream
+
     async def work_done(self, msg):
-        try:
-            future = self.futures.pop(msg[Keys.WORK_ID])
-        except KeyError:
+        if msg.flags & Flags.ITEMS and msg.work_id not in self.streams:
+            # The stream ended without any items
+            future = self.futures.get(msg.work_id)
+            if future is not None and not future.done():
+                self._open_stream(msg.work_id, future)
+
+        stream = self.streams.pop(msg.work_id, None)
+        if stream is not None:
+            self._pop(msg.work_id)
+            stream = stream()
+            if stream is not None:
+                stream.finish(WorkException(msg.payload) if msg.error else None)
+            return
+
+        started = self.started.get(msg.work_id)
+        future = self._pop(msg.work_id)
+        if future is None:
             logger.error(
                 f"Worker finished working on a cion_interface, but no such work was started by this orchestrator instance.")
-            logger.info(
-                ", ".join(map(lambda item: f"{item[0]}: {item[1]}", msg.items())))
+            logger.info(msg)
             return
 
-        if len(self.futures) <= 0:
-            self.state = ClientState.IDLE
-
         if future.cancelled():
             logger.debug("Future cancelled, discarding result.")
             return
 
-        if Keys.WORK_EXC in msg:
-            future.set_exception(WorkException(msg[Keys.WORK_EXC]))
+        if msg.error:
+            future.set_exception(WorkException(msg.payload))
         else:
-            future.set_result(msg[Keys.WORK_RESULT])
+            self._measure(*started)
+            future.set_result(msg.payload)
+
+    async def probe(self):
+        """Measure the round trip time to the client, unless a probe is underway already."""
+        if self.probe_sent is None:
+            self.probe_sent = asyncio.get_event_loop().time()
+            await self.stream.send(probe)
+
+    def probed(self):
+        if self.probe_sent is not None:
+            self.rtt = _smoothed(self.rtt, asyncio.get_event_loop().time() - self.probe_sent)
+            self.probe_sent = None
+
+    def _measure(self, started, calls):
+        self.service_time = _smoothed(self.service_time, (asyncio.get_event_loop().time() - started) / calls)
+
+    def _pop(self, work_id):
+        future = self.futures.pop(work_id, None)
+        if future is not None:
+            del self.work_tasks[work_id]
+            del self.started[work_id]
+            self.stealing.pop(work_id, None)
+            # An upload cancelled partway through a chunk still writes the rest of it, see `Stream.send`
+            for upload in self.work_uploads.pop(work_id, ()):
+                upload.cancel()
+            self.load_changed()
+
+        return future
 
     def disconnected(self):
-        for future in self.futures.values():
-            future.set_exception(ClientDisconnectedException())
+        for work_id, future in self.futures.items():
+            if not future.done() and work_id not in self.streams:
+                future.set_exception(ClientDisconnectedException())
+
+        for stream in self.streams.values():
+            stream = stream()
+            if stream is not None:
+                stream.finish(ClientDisconnectedException())
 
     @property
     def name(self):
@@ -64,10 +354,24 @@ class WorkException(Exception):
         self.trace = trace
 
 
+def _smoothed(average, sample):
+    """:return: The moving `average` with `sample` added, or `sample` as the first one."""
+    return sample if average is None else average + SMOOTHING * (sample - average)
+
+
 class ClientDisconnectedException(Exception):
     pass
 
 
+class WorkReleasedException(Exception):
+    """The client gave back work it had not started, see `Client.steal`."""
+
+    def __init__(self, thief=None):
+        super().__init__()
+        # The client the work was asked back for, or None
+        self.thief = thief
+
+
 class ClientState(IntEnum):
     IDLE = auto()
     WORKING = auto()
@@ -0,0 +1,686 @@
+import asyncio
+import hashlib
+import heapq
+import pickle
+import random
+from bisect import bisect_left, insort
+from collections import OrderedDict, defaultdict, deque
+from functools import partial
+from itertools import chain, count
+
+from logzero import logger
+
+from .client import ClientDisconnectedException, WorkReleasedException
+from ..net.upload import Upload
+
+
+def affinity_hash(key):
+    """:return: A position on a `HashRing` for `key`, the same in every process."""
+    return int.from_bytes(hashlib.md5(pickle.dumps(key, protocol=4)).digest()[:8], 'little')
+
+
+class HashRing:
+    """
+    Consistent hash ring of clients, each placed at `replicas` points by its identity. Adding or removing a client only
+    moves the keys between its points and the points before them, and a client that reconnects takes its points back.
+    """
+
+    def __init__(self, replicas=64):
+        self.replicas = replicas
+        self.points = []
+        self.owners = []
+
+    def add(self, client):
+        for replica in range(self.replicas):
+            point = affinity_hash(f"{client.identity}#{replica}")
+            i = bisect_left(self.points, point)
+            self.points.insert(i, point)
+            self.owners.insert(i, client)
+
+    def remove(self, client):
+        kept = [(point, owner) for point, owner in zip(self.points, self.owners) if owner is not client]
+        self.points = [point for point, _ in kept]
+        self.owners = [owner for _, owner in kept]
+
+    def walk(self, position):
+        """:return: An iterator over the distinct clients in ring order, starting from the owner of `position`."""
+        owners = self.owners
+        start = bisect_left(self.points, position)
+        seen = set()
+
+        for i in range(start, start + len(owners)):
+            owner = owners[i % len(owners)]
+            if owner not in seen:
+                seen.add(owner)
+                yield owner
+
+
+class WorkerPool:
+    """
+    Scheduling index over the clients supporting one interface.
+
+    Idle clients are kept in the order they became idle, and are handed out first in, first out. Busy clients are kept
+    in a heap ordered by their load, the fraction of their slots in use. Entries in the heap are not removed when a
+    client's load changes, instead they are skipped once they reach the top. When every client is saturated, callers of
+    `acquire` queue up until a slot frees.
+
+    With `choices`, clients are selected by the power of d choices instead: the cheapest of `choices` clients picked at
+    random among those with a free slot, and the client selected last time, see `cost`. This takes the speed of the
+    clients into account, without sending every call to the fastest one, as a client's cost grows with its load.
+
+    Calls with an affinity key are routed on a consistent hash ring of the clients, which is only built once it is first
+    used.
+
+    Clients that could give back more than one piece of work, see `Client.steal`, are kept in a heap ordered by how many
+    they could give back, with stale entries skipped like those of busy clients.
+    """
+
+    def __init__(self, choices=None):
+        self.idle = OrderedDict()
+        self.busy = []
+        self.loads = {}
+        self.sequence = count()
+        self.waiters = deque()
+        self.ring = None
+        # Heap of (-stealable, sequence, client), and the work each client could give back as of its last update
+        self.victims = []
+        self.stealable = {}
+
+        self.choices = choices
+        self.random = random.Random()
+        # Clients with a free slot, and their index in the list, if selecting by `choices`
+        self.available = []
+        self.available_index = {}
+        self.best = None
+
+    def __len__(self):
+        return len(self.loads)
+
+    def __contains__(self, client):
+        return client in self.loads
+
+    def __iter__(self):
+        return iter(self.loads)
+
+    def add(self, client):
+        client.pools.append(self)
+        self.loads[client] = None
+        if self.ring is not None:
+            self.ring.add(client)
+
+        self.update(client)
+
+    def remove(self, client):
+        client.pools.remove(self)
+        del self.loads[client]
+        self.stealable.pop(client, None)
+        self.idle.pop(client, None)
+        if self.ring is not None:
+            self.ring.remove(client)
+        if client in self.available_index:
+            self._unavailable(client)
+        if self.best is client:
+            self.best = None
+
+    def update(self, client):
+        """Re-index `client` after its load has changed, and hand any slot it freed to a waiting caller."""
+        stealable = client.stealable
+        if self.stealable.get(client) != stealable:
+            self.stealable[client] = stealable
+            if stealable > 1:
+                heapq.heappush(self.victims, (-stealable, next(self.sequence), client))
+
+                if len(self.victims) > 2 * len(self.loads) + 16:
+                    self.victims = [(-n, next(self.sequence), other) for other, n in self.stealable.items() if n > 1]
+                    heapq.heapify(self.victims)
+
+        load = client.load
+        previous = self.loads[client]
+        if previous == load:
+            return
+
+        self.loads[client] = load
+
+        if client.in_flight == 0:
+            self.idle[client] = None
+        else:
+            self.idle.pop(client, None)
+            heapq.heappush(self.busy, (load, next(self.sequence), client))
+
+            if len(self.busy) > 2 * len(self.loads) + 16:
+                self._compact()
+
+        if self.choices:
+            if load < 1 and client not in self.available_index:
+                self.available_index[client] = len(self.available)
+                self.available.append(client)
+            elif load >= 1 and client in self.available_index:
+                self._unavailable(client)
+
+        if previous is None:
+            self.wake(client.capacity - client.in_flight)
+        elif load < previous:
+            self.wake(1)
+
+    def select(self, exclude=None):
+        """
+        :return: An idle client if there is one, else the least loaded client with a free slot, or None if every client
+        is saturated or the pool is empty. Never `exclude`. With `choices`, the cheapest of that many random clients with
+        a free slot instead.
+        """
+        if self.choices:
+            return self._sample(exclude)
+
+        for client in self.idle:
+            if client is not exclude:
+                return client
+
+        busy = self.busy
+        loads = self.loads
+        excluded = None
+        selected = None
+        while busy:
+            load, _, client = busy[0]
+            if loads.get(client) != load:
+                heapq.heappop(busy)
+            elif client is exclude and excluded is None:
+                excluded = heapq.heappop(busy)
+            else:
+                selected = client if load < 1 else None
+                break
+
+        if excluded is not None:
+            heapq.heappush(busy, excluded)
+
+        return selected
+
+    def victim(self):
+        """:return: The client that could give back the most work, if that is more than one piece, else None."""
+        victims = self.victims
+        while victims:
+            stealable, _, client = victims[0]
+            if self.stealable.get(client) == -stealable:
+                return client
+
+            heapq.heappop(victims)
+
+        return None
+
+    @staticmethod
+    def cost(client):
+        """
+        The expected time for `client` to complete one more call, from its average latencies. Those not measured yet
+        count as none, so a new client is tried out until its first results come back.
+        """
+        return (client.in_flight + 1) / client.capacity * (client.service_time or 0.0) + (client.rtt or 0.0)
+
+    def _sample(self, exclude):
+        available = self.available
+        if not available:
+            return None
+
+        candidates = [available[self.random.randrange(len(available))] for _ in range(self.choices)]
+        if self.best in self.available_index:
+            candidates.append(self.best)
+
+        candidates = [client for client in candidates if client is not exclude]
+        if not candidates:
+            return next((client for client in available if client is not exclude), None)
+
+        self.best = min(candidates, key=self.cost)
+        return self.best
+
+    def _unavailable(self, client):
+        # Swap the last client into its place, to remove it in constant time
+        i = self.available_index.pop(client)
+        last = self.available.pop()
+        if last is not client:
+            self.available[i] = last
+            self.available_index[last] = i
+
+    def route(self, position):
+        """
+        :return: The client owning `position` on the hash ring if it has a free slot, else the next client along the
+        ring that has one, or None if every client is saturated.
+        """
+        if self.ring is None:
+            self.ring = HashRing()
+            for client in self.loads:
+                self.ring.add(client)
+
+        for client in self.ring.walk(position):
+            if self.loads[client] < 1:
+                return client
+
+        return None
+
+    async def acquire(self):
+        """
+        :return: A client with a free slot, as chosen by `select`. If there is none, or other callers are already
+        waiting, wait in line until one frees up. The slot must be taken before control returns to the event loop.
+        """
+        if not self.waiters:
+            client = self.select()
+            if client is not None:
+                return client
+
+        waiter = asyncio.get_event_loop().create_future()
+        self.waiters.append(waiter)
+
+        while True:
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if not waiter.cancelled():
+                    self.wake(1)  # Woken up for a slot, so pass it on to the next in line
+                raise
+
+            client = self.select()
+            if client is not None:
+                return client
+
+            # Someone else got to the slot first, so wait at the front of the line for the next one
+            waiter = asyncio.get_event_loop().create_future()
+            self.waiters.appendleft(waiter)
+
+    def wake(self, n=1):
+        """Hand `n` freed slots to the callers waiting longest in `acquire`."""
+        # Waiters of cancelled callers are left in line, and skipped here
+        while n > 0 and self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                n -= 1
+
+    def _compact(self):
+        self.busy = [(load, next(self.sequence), client) for client, load in self.loads.items() if load]
+        heapq.heapify(self.busy)
+
+
+class Call:
+    __slots__ = ('args', 'kwargs', 'future', 'priority', 'queued_at', 'deadline', 'affinity', 'detached', 'uploads',
+                 'tries', 'running', 'queued', 'launched')
+
+    def __init__(self, args, kwargs, future, priority, queued_at, deadline, affinity, detached=False, uploads=False):
+        # A batch of calls has a list of positional argument tuples as `args`, and None as `kwargs`
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.priority = priority
+        self.queued_at = queued_at
+        # Loop time after which the call fails with a TimeoutError, or None
+        self.deadline = deadline
+        # Position of the call's affinity key on the hash ring, or None
+        self.affinity = affinity
+        # Whether the call is done once sent, without waiting for its result, see `Client.start_detached`
+        self.detached = detached
+        # Whether the call has `Upload` arguments, which can only be sent once, so it is never hedged or restarted
+        self.uploads = uploads
+        self.tries = 0
+        # Attempts at the call in flight, more than one once it is hedged
+        self.running = 0
+        # Whether the call counts towards the length of its queue
+        self.queued = False
+        # Loop time the call was first sent to a client, or None
+        self.launched = None
+
+
+class WaitStats:
+    """Time spent waiting in a queue by the calls of one priority class, in seconds."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, wait):
+        self.count += 1
+        self.total += wait
+        self.max = max(self.max, wait)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def __repr__(self):
+        return f"WaitStats(count={self.count}, mean={self.mean:.6f}, max={self.max:.6f})"
+
+
+class LatencyTracker:
+    """Percentiles of the last `window` latencies of a task, in seconds, once there are at least `min_samples`."""
+
+    def __init__(self, window=1000, min_samples=20):
+        self.window = window
+        self.min_samples = min_samples
+        self.samples = deque()
+        self.sorted = []
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, latency):
+        if len(self.samples) == self.window:
+            del self.sorted[bisect_left(self.sorted, self.samples.popleft())]
+
+        self.samples.append(latency)
+        insort(self.sorted, latency)
+
+    def percentile(self, q):
+        """:return: The latency that a fraction `q` of the samples did not exceed, or None if there are too few."""
+        if len(self.sorted) < self.min_samples:
+            return None
+
+        return self.sorted[min(int(q * len(self.sorted)), len(self.sorted) - 1)]
+
+
+class TaskQueue:
+    """
+    Bounded priority queue of calls to one task, waiting for a slot on any of the clients in `pool`.
+
+    Calls are handed out as soon as a slot frees up, highest priority first. To keep a steady stream of high priority
+    calls from starving the others, a call is ordered as if it was queued `aging` seconds earlier for every level of
+    priority it has, so calls of equal priority are first in, first out, and any call eventually reaches the front.
+    Once `maxsize` calls are waiting, callers of `put` wait for room in the queue, so a burst of calls is held back at
+    its source rather than piling up here.
+
+    Calls of a task declared with an `affinity` key go to the client owning the key on the pool's hash ring, or the
+    next one along the ring with a free slot.
+
+    For a task declared with `hedge`, a call that takes longer than that percentile of the latencies of the task's
+    recent calls, from their first attempt to their result or deadline, is started again on a second client, if one
+    has a free slot and no other calls are waiting. The first attempt to finish decides the call, and the other is
+    cancelled. Batches are neither timed nor hedged, as they take longer than single calls by their size.
+
+    Calls are restarted on another client if theirs is lost or gives them back, except calls with `Upload` arguments,
+    whose sources can't be read again. Those fail instead, and are not hedged either.
+    """
+
+    def __init__(self, task, pool, maxsize=1024, retries=3, aging=1.0, loop=None):
+        self.task = task
+        self.pool = pool
+        self.maxsize = maxsize
+        self.retries = retries
+        self.aging = aging
+        self.loop = loop or asyncio.get_event_loop()
+        # Heap of (virtual queue time, sequence, call)
+        self.calls = []
+        self.sequence = count()
+        # Queue wait of the dispatched calls, by priority
+        self.waits = defaultdict(WaitStats)
+        # Time from starting a call on a client to its result
+        self.latency = LatencyTracker()
+        self.hedged = 0
+        self.hedges_won = 0
+        self.admissions = deque()
+        self.admitted = 0
+        # Calls cancelled while in the queue, which are only removed once they reach its head
+        self.dropped = 0
+        self.nonempty = None
+
+        self.dispatcher = asyncio.ensure_future(self.dispatch(), loop=self.loop)
+
+    def __len__(self):
+        return len(self.calls) - self.dropped
+
+    def full(self):
+        return len(self) + self.admitted >= self.maxsize
+
+    async def put(self, args, kwargs, priority=0, timeout=None):
+        """
+        Queue a call with `args` and `kwargs`, once there is room for it. Calls with a higher `priority` are handed out
+        first. With `kwargs` None, `args` is a list of positional argument tuples to run as a single batch, see
+        `Client.start_batch`.
+        :param timeout: Seconds from now after which the call fails with a TimeoutError, counting the time spent waiting
+        for room. The worker is told to stop working on it at the same time.
+        :return: A future for the result of the call.
+        """
+        deadline = None if timeout is None else self.loop.time() + timeout
+        # Before waiting for room, so an affinity function that raises doesn't take it from the calls behind this one
+        affinity = self._affinity(args, kwargs)
+
+        if self.full() or self.admissions:
+            admission = self.loop.create_future()
+            self.admissions.append(admission)
+
+            try:
+                await admission
+            except asyncio.CancelledError:
+                if not admission.cancelled():
+                    # Admitted already, so pass the room on to the next in line
+                    self.admitted -= 1
+                    self._admit()
+                raise
+
+            self.admitted -= 1
+
+        return self._enqueue(args, kwargs, priority, deadline, affinity)
+
+    def put_nowait(self, args, kwargs, priority=0, timeout=None, detached=False):
+        """
+        Like `put`, but raise `asyncio.QueueFull` instead of waiting for room.
+        :param detached: Leave the outcome of the call unreported, so its future resolves to None once it is sent to a
+        client. Detached calls are not retried.
+        """
+        if self.full() or self.admissions:
+            raise asyncio.QueueFull()
+
+        deadline = None if timeout is None else self.loop.time() + timeout
+        return self._enqueue(args, kwargs, priority, deadline, self._affinity(args, kwargs), detached)
+
+    def _affinity(self, args, kwargs):
+        """:return: The position on the hash ring of the call's affinity key, or None. Batches have no affinity."""
+        if self.task.affinity is None or kwargs is None:
+            return None
+
+        return affinity_hash(self.task.affinity(*args, **kwargs))
+
+    def _enqueue(self, args, kwargs, priority, deadline, affinity, detached=False):
+        uploads = kwargs is not None and any(isinstance(value, Upload) for value in chain(args, kwargs.values()))
+        call = Call(args, kwargs, self.loop.create_future(), priority, self.loop.time(), deadline, affinity, detached,
+                    uploads)
+        call.future.add_done_callback(partial(self._cancelled, call))
+
+        if deadline is not None:
+            expiry = self.loop.call_at(deadline, _expire, call.future)
+            call.future.add_done_callback(lambda _: expiry.cancel())
+
+        self._push(call)
+        return call.future
+
+    def close(self):
+        self.dispatcher.cancel()
+
+        calls, self.calls = self.calls, []
+        for _, _, call in calls:
+            call.queued = False
+            call.future.cancel()
+
+        for admission in self.admissions:
+            admission.cancel()
+        self.admissions.clear()
+
+    async def dispatch(self):
+        while True:
+            if not self._skip_cancelled():
+                self.nonempty = self.loop.create_future()
+                await self.nonempty
+                continue
+
+            client = await self.pool.acquire()
+
+            if not self._skip_cancelled():
+                self.pool.wake()  # Nothing left to run, so give the slot to whoever else is waiting for one
+                continue
+
+            self._dispatch(client)
+
+    def _dispatch(self, client):
+        """Start the call at the head of the queue on `client`, or the client it prefers."""
+        _, _, call = heapq.heappop(self.calls)
+        call.queued = False
+        self._admit()
+
+        if call.tries == 0:
+            self.waits[call.priority].add(self.loop.time() - call.queued_at)
+
+        if call.affinity is None:
+            self._start(client, call)
+        else:
+            # There is a free slot, as `client` has one, but the call may prefer another client's
+            preferred = self.pool.route(call.affinity)
+            self._start(preferred, call)
+
+            if preferred is not client:
+                self.pool.wake()
+
+    def _start(self, client, call):
+        call.tries += 1
+        single = call.kwargs is not None and not call.detached
+        if call.launched is None and single:
+            call.launched = self.loop.time()
+            call.future.add_done_callback(partial(self._sample, call))
+
+        self._launch(client, call)
+
+        threshold = None if call.uploads or not single else self.task.hedge and self.latency.percentile(self.task.hedge)
+        if threshold is not None and call.running == 1:
+            hedge = self.loop.call_later(threshold, self._hedge, client, call)
+            call.future.add_done_callback(lambda _: hedge.cancel())
+
+    def _hedge(self, client, call):
+        if call.future.done() or call.running != 1 or len(self):
+            return
+
+        # A slot that frees up belongs to the calls of other tasks waiting for one
+        if any(not waiter.done() for waiter in self.pool.waiters):
+            return
+
+        other = self.pool.select(exclude=client)
+        if other is None:
+            return
+
+        self.hedged += 1
+        self._launch(other, call, hedge=True)
+
+    def _launch(self, client, call, hedge=False):
+        logger.debug(f"Starting task {self.task.signature} on client {client.name}")
+
+        timeout = None if call.deadline is None else call.deadline - self.loop.time()
+        if call.detached:
+            client.start_detached(self.task, call.args, call.kwargs, timeout)
+            call.future.set_result(None)
+            return
+
+        call.running += 1
+        if call.kwargs is None:
+            work = client.start_batch(self.task, call.args, timeout)
+        else:
+            work = client.start(self.task, call.args, call.kwargs, timeout)
+        work.add_done_callback(partial(self._finished, call, hedge))
+        call.future.add_done_callback(partial(_cancel_work, work))
+
+    def _finished(self, call, hedge, work):
+        call.running -= 1
+        if call.future.done():
+            return
+
+        if work.cancelled():
+            call.future.cancel()
+            return
+
+        exception = work.exception()
+        if isinstance(exception, WorkReleasedException):
+            if call.running > 0:
+                return
+
+            if not call.uploads:
+                # Never started, so it does not count as a try
+                call.tries -= 1
+                thief = exception.thief
+                if thief is not None and thief in self.pool and thief.load < 1:
+                    self._start(thief, call)  # The idle client it was given back for
+                else:
+                    self._push(call, front=True)
+                return
+
+            exception = self._aborted(call)
+
+        elif isinstance(exception, ClientDisconnectedException):
+            if call.running > 0:
+                return  # The other attempt of a hedged call may still succeed
+
+            if call.tries < self.retries and not call.uploads:
+                # Find a new client to restart the call on, ahead of calls that have not been started yet
+                self._push(call, front=True)
+                return
+
+            exception = self._aborted(call)
+
+        if exception is None:
+            if hedge:
+                self.hedges_won += 1
+
+            call.future.set_result(work.result())
+        else:
+            call.future.set_exception(exception)
+
+    def _sample(self, call, future):
+        # Timed from the first attempt, so a straggler counts as slow even when a hedge or retry of it wins, and a call
+        # that ran into its deadline as at least that slow
+        if future.cancelled():
+            return
+
+        exception = future.exception()
+        if exception is None or isinstance(exception, asyncio.TimeoutError):
+            self.latency.add(self.loop.time() - call.launched)
+
+    def _aborted(self, call):
+        if call.kwargs is None:
+            return Exception(f"Aborting batch of {len(call.args)} {self.task.pretty_name} tasks")
+
+        arglist = list(map(repr, call.args))
+        arglist.extend(f"{kw}={val!r}" for kw, val in call.kwargs.items())
+        return Exception(f"Aborting task {self.task.pretty_name} as {self.task.name}({', '.join(arglist)})")
+
+    def _push(self, call, front=False):
+        call.queued = True
+        key = float('-inf') if front else call.queued_at - call.priority * self.aging
+        heapq.heappush(self.calls, (key, next(self.sequence), call))
+
+        if self.nonempty is not None and not self.nonempty.done():
+            self.nonempty.set_result(None)
+
+    def _skip_cancelled(self):
+        calls = self.calls
+        while calls and calls[0][2].future.done():
+            _, _, call = heapq.heappop(calls)
+            if call.queued:
+                call.queued = False  # Its callback has not run yet, and will find it gone
+            else:
+                self.dropped -= 1
+
+        return bool(calls)
+
+    def _cancelled(self, call, future):
+        if call.queued:
+            call.queued = False
+            self.dropped += 1
+            self._admit()
+
+    def _admit(self):
+        while self.admissions and not self.full():
+            admission = self.admissions.popleft()
+            if not admission.done():
+                self.admitted += 1
+                admission.set_result(None)
+
+
+def _cancel_work(work, future):
+    # The call was cancelled or timed out before the work finished
+    if not work.done():
+        work.cancel()
+
+
+def _expire(future):
+    if not future.done():
+        future.set_exception(asyncio.TimeoutError())
@@ -1,23 +1,40 @@
 import asyncio
 import socket
 import ssl
-from collections import defaultdict
+from collections import defaultdict, deque
+from functools import partial
+from itertools import islice
 
 from logzero import logger
 
-from .client import Client, ClientState, ClientDisconnectedException
-from ..net.messages import Types, Keys, ok, error, ping
+from .cache import ResultCache, arguments_key
+from .client import Client, WorkException
+from .scheduling import WorkerPool, TaskQueue
+from ..net.flow import ItemStream
+from ..net.messages import Types, Flags, ok, error, ping
 from ..net.stream import Stream
 
 
 class Server:
-    def __init__(self, hc_sleep=5):
+    def __init__(self, hc_sleep=5, max_queued=1024, aging=1.0, steal=True, choices=2):
+        """
+        :param choices: Select workers by the power of this many choices, weighing their latencies. None to select the
+        least loaded worker instead.
+        """
         self.interfaces = {}
         self.interfaces_hash = []
-        self.clients_supporting = defaultdict(lambda: [])
-        self.clients = []
+        # Scheduling index of the clients supporting each interface, by interface signature
+        self.clients_supporting = defaultdict(partial(WorkerPool, choices))
+        self.clients = set()
         self.loop = asyncio.get_event_loop()
-        self.waiting_tasks = defaultdict(lambda: [])
+        # Calls waiting for a worker, and results of tasks declared with a cache, by task signature
+        self.queues = {}
+        self.caches = {}
+        # Calls of tasks declared to coalesce, by task signature, arguments key and priority
+        self.flights = {}
+        self.max_queued = max_queued
+        self.aging = aging
+        self.steal = steal
         self.alive = True
         self.health_check_timeout = hc_sleep
 
@@ -27,11 +44,13 @@ class Server:
         while self.alive:
             await asyncio.sleep(self.health_check_timeout)
 
-            for tasks in self.waiting_tasks.values():
-                num_waiting_tasks = len(tasks)
-                first_task, _ = tasks[0]
-                if num_waiting_tasks > 0:
-                    logger.warning(f"{num_waiting_tasks} {first_task.pretty_name} task(s) without any clients "
+            for client in list(self.clients):
+                asyncio.ensure_future(self.probe(client), loop=self.loop)
+
+            for queue in self.queues.values():
+                num_waiting_tasks = len(queue)
+                if num_waiting_tasks > 0 and not queue.pool:
+                    logger.warning(f"{num_waiting_tasks} {queue.task.pretty_name} task(s) without any clients "
                                    "implementing their cion_interface.")
 
     def enable(self, interface):
@@ -39,35 +58,134 @@ class Server:
         self.interfaces_hash.append(interface.signature)
         interface.enable(self)
 
-    async def find_worker(self, task):
-        workers = self.clients_supporting[task.signature]
+    def queue(self, task):
         try:
-            return next(filter(lambda c: c.state == ClientState.IDLE, workers))
-        except StopIteration:
-            if len(workers) > 0:
-                worker = workers.pop(0)
-                workers.append(worker)
-                return worker
-            else:
-                fut = self.loop.create_future()
-                self.waiting_tasks[task.signature].append((task, fut))
-                return await fut
-
-    async def start_task(self, task, args, kwargs):
-        for try_num in range(3):
-            worker = await self.find_worker(task)
-
-            logger.debug(
-                f"Starting task {task.signature} on client {worker.name}")
+            return self.queues[task.signature]
+        except KeyError:
+            pool = self.clients_supporting[task.member_of.signature]
+            queue = self.queues[task.signature] = TaskQueue(task, pool, self.max_queued, aging=self.aging,
+                                                            loop=self.loop)
+            return queue
+
+    async def submit(self, task, args, kwargs, priority=0, timeout=None):
+        """
+        Queue a call to `task`, waiting for room in its queue if it is full.
+        :return: A future for the result of the call.
+        """
+        return await self.queue(task).put(args, kwargs, priority, timeout)
+
+    def submit_nowait(self, task, args, kwargs, priority=0, timeout=None):
+        """
+        Queue a call to `task` whose result is not needed. The worker does not report back on it, which saves a message
+        per call, so failures only show in the worker's log.
+        :raises asyncio.QueueFull: If the queue of `task` is full.
+        """
+        self.queue(task).put_nowait(args, kwargs, priority, timeout, detached=True)
+
+    def result_cache(self, task):
+        """:return: The result cache of `task`, or None if it was not declared with one."""
+        if not task.cache:
+            return None
 
-            try:
-                return await worker.start(task, args, kwargs)
-            except ClientDisconnectedException:
-                continue  # Find new worker to restart task on
+        try:
+            return self.caches[task.signature]
+        except KeyError:
+            options = task.cache if isinstance(task.cache, dict) else {}
+            cache = self.caches[task.signature] = ResultCache(**options)
+            return cache
+
+    async def start_task(self, task, args, kwargs, **options):
+        cache = self.result_cache(task)
+        key = arguments_key(args, kwargs) if cache is not None or task.coalesce else None
+
+        if cache is not None and key is not None:
+            hit, result = cache.get(key)
+            if hit:
+                return result
+
+        if not task.coalesce or key is None:
+            return await self.run_task(task, args, kwargs, options, cache, key)
+
+        # Calls of different priority are queued apart, so they are not coalesced either
+        flight_key = task.signature, key, options.get('priority', 0)
+        flight = self.flights.get(flight_key)
+        leader = flight is None
+        if leader:
+            # The call itself has no deadline, as each caller waits for it until its own timeout
+            running = self.run_task(task, args, kwargs, dict(options, timeout=None), cache, key)
+            flight = self.flights[flight_key] = Flight(asyncio.ensure_future(running, loop=self.loop))
+            flight.future.add_done_callback(lambda _: self._landed(flight_key, flight))
+
+        flight.waiters += 1
+        try:
+            # A caller giving up must not cancel the call for the others waiting on it
+            waiting = asyncio.shield(flight.future, loop=self.loop)
+            result = await asyncio.wait_for(waiting, options.get('timeout'), loop=self.loop)
+        finally:
+            flight.waiters -= 1
+            if not flight.waiters and not flight.future.done():
+                # The last caller gave up
+                self._landed(flight_key, flight)
+                flight.future.cancel()
+
+        if isinstance(result, ItemStream) and not leader:
+            # A stream has a single consumer, so the callers that joined the call make calls of their own
+            return await self.run_task(task, args, kwargs, options)
+
+        return result
+
+    def _landed(self, flight_key, flight):
+        if self.flights.get(flight_key) is flight:
+            del self.flights[flight_key]
+
+    async def run_task(self, task, args, kwargs, options, cache=None, key=None):
+        result = await self.submit(task, args, kwargs, **options)
+        result = await result
+
+        if cache is not None and key is not None and not isinstance(result, ItemStream):
+            cache.put(key, result)
+
+        return result
+
+    async def map_task(self, task, arglist, chunksize=64, ordered=True, **options):
+        """
+        Run `task` for each tuple of positional arguments in `arglist`. Calls are sent to the workers in batches of
+        `chunksize`, each of which is run as one piece of work, and answered in one message.
+        :param ordered: Yield the results in the order of `arglist`, instead of as their batches complete.
+        :return: An async iterator over the results. A call that failed raises `WorkException` in its place.
+        """
+        assert chunksize > 0, "Chunk size must be at least one call"
+
+        queue = self.queue(task)
+        pending = deque()
+
+        try:
+            for chunk in _chunks(arglist, chunksize):
+                pending.append(await queue.put(chunk, None, **options))
 
-        arglist = list(args)
-        arglist.extend(f"{kw}={val}" for kw, val in kwargs.iter())
-        raise Exception(f"Aborting task {task}({', '.join(arglist)})")
+                # Yield what is done already, while the rest of the batches are queued
+                for batch in _pop_done(pending, ordered):
+                    for result in _unbatch(batch):
+                        yield result
+
+            while pending:
+                await asyncio.wait([pending[0]] if ordered else pending, loop=self.loop,
+                                   return_when=asyncio.FIRST_COMPLETED)
+
+                for batch in _pop_done(pending, ordered):
+                    for result in _unbatch(batch):
+                        yield result
+        finally:
+            for batch in pending:
+                batch.cancel()
+
+    def queue_waits(self):
+        """:return: Statistics on the time calls spent queued, by task signature and then priority."""
+        return {signature: dict(queue.waits) for signature, queue in self.queues.items()}
+
+    def cache_stats(self):
+        """:return: Hit, miss and eviction counts, and the size of each result cache, by task signature."""
+        return {signature: cache.stats() for signature, cache in self.caches.items()}
 
     def run(self, addr, port, certs=None):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -106,7 +224,10 @@ class Server:
             logger.exception("Uncaught exception :")
 
     def shutdown(self):
-        for client in self.clients:
+        for queue in self.queues.values():
+            queue.close()
+
+        for client in list(self.clients):
             self.disconnect_client(client)
 
     async def socket_connect(self, stream, peer):
@@ -114,24 +235,24 @@ class Server:
         logger.info(f"Connection from {addr}:{port}")
 
         client = Client(addr, port, stream)
-        self.clients.append(client)
+        self.clients.add(client)
 
         try:
             while True:
-                try:
-                    msg = await stream.decode()
-                except ModuleNotFoundError:
-                    logger.exception(
-                        "Client {client.name} sent bad message. Look at client logs.")
-                    continue
+                msg = await stream.decode()
 
                 try:
-                    handler = dispatch_table[msg[Keys.TYPE]]
+                    handler = dispatch_table[msg.type]
                 except KeyError:
                     logger.warning("Unknown message type.")
                     continue
 
-                await handler(self, client, msg)
+                try:
+                    # Payloads are unpickled on first access, which happens in the handler
+                    await handler(self, client, msg)
+                except ModuleNotFoundError:
+                    logger.exception(
+                        f"Client {client.name} sent bad message. Look at client logs.")
         except ConnectionResetError:
             logger.info(
                 f"Client {client.addr}:{client.port} forcefully disconnected.")
@@ -143,27 +264,31 @@ class Server:
 
     def disconnect_client(self, client):
         self.clients.remove(client)
-        for interface in client.supported_interfaces:
-            for task in interface.tasks.values():
-                self.clients_supporting[task.signature].remove(client)
-
+        self.withdraw(client)
         client.disconnected()
 
+    def withdraw(self, client):
+        """Stop sending `client` work, by taking it out of the pools of the interfaces it supports."""
+        for interface in client.supported_interfaces:
+            pool = self.clients_supporting[interface.signature]
+            if client in pool:
+                pool.remove(client)
+
     async def supports(self, client, msg):
-        interface_hash = msg[Keys.INTERFACE]
+        interface_hash, capacity, identity = msg.payload
         if interface_hash in self.interfaces_hash:
             interface = self.interfaces[interface_hash]
 
-            client.supports(interface)
-
-            for task in interface.tasks.values():
-                self.clients_supporting[task.signature].append(client)
+            task_ids = client.supports(interface)
+            client.capacity = capacity
+            client.identity = identity
 
-                if task.signature in self.waiting_tasks:
-                    for _, future in self.waiting_tasks.pop(task.signature):
-                        future.set_result(client)
+            # Adding the client hands its slots to the queues waiting on this interface
+            pool = self.clients_supporting[interface.signature]
+            if client not in pool:
+                pool.add(client)
 
-            await client.stream.send(ok())
+            await client.stream.send(ok(tasks=task_ids))
         else:
             await client.stream.send(error("Server does not use this cion_interface"))
 
@@ -171,13 +296,105 @@ class Server:
         logger.debug(f"Worker {client.name} returned result {msg}")
         await client.work_done(msg)
 
+        if self.steal and client.in_flight == 0:
+            self.steal_for(client)
+
+    def steal_for(self, client):
+        """
+        Find work for idle `client` that another client has been sent, but has not started yet. Work is only taken from
+        the client with the most work it could give back, and only if it has more than one piece of work in flight, and
+        no calls are waiting for a slot already. Once given back, the work is started on `client`, if it still has a free
+        slot by then.
+        """
+        for interface in client.supported_interfaces:
+            pool = self.clients_supporting[interface.signature]
+            if pool.waiters or client not in pool:
+                continue
+
+            victim = pool.victim()
+            if victim is not None and victim.steal(interface, client):
+                logger.debug(f"Stealing work from client {victim.name} for client {client.name}")
+                return
+
+    async def released(self, client, msg):
+        client.released(msg)
+
+    async def work_item(self, client, msg):
+        client.work_item(msg)
+
+    async def credit(self, client, msg):
+        client.credit(msg)
+
+    async def completed(self, client, msg):
+        client.completed(msg)
+
+    async def leave(self, client, msg):
+        logger.info(f"Client {client.name} is leaving, sending it no more work.")
+        self.withdraw(client)
+
+    async def probe(self, client):
+        try:
+            await client.probe()
+        except OSError:
+            pass  # Disconnected, which the connection handler takes care of
+
     async def recv_ping(self, client, msg):
+        if msg.flags & Flags.PROBE:
+            client.probed()
+            return
+
         logger.log(0, f"Received keep-alive ping from client {client.name}")
         await client.stream.send(ping)
 
 
+class Flight:
+    """A call of a task declared to coalesce, and the number of callers waiting for it."""
+    __slots__ = ('future', 'waiters')
+
+    def __init__(self, future):
+        self.future = future
+        self.waiters = 0
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+
+        yield chunk
+
+
+def _pop_done(pending, ordered):
+    if ordered:
+        while pending and pending[0].done():
+            yield pending.popleft()
+    else:
+        done = [future for future in pending if future.done()]
+        if done:
+            remaining = [future for future in pending if not future.done()]
+            pending.clear()
+            pending.extend(remaining)
+
+        yield from done
+
+
+def _unbatch(batch):
+    for succeeded, result in batch.result():
+        if not succeeded:
+            raise WorkException(result)
+
+        yield result
+
+
 dispatch_table = {
     Types.SUPPORTS: Server.supports,
     Types.WORK_COMPLETE: Server.work_done,
-    Types.PING: Server.recv_ping
+    Types.PING: Server.recv_ping,
+    Types.RELEASE: Server.released,
+    Types.WORK_ITEM: Server.work_item,
+    Types.CREDIT: Server.credit,
+    Types.COMPLETED: Server.completed,
+    Types.LEAVE: Server.leave
 }
@@ -1 +1,2 @@
-from .orchestrator import Orchestrator
\ No newline at end of file
+from .orchestrator import Orchestrator
+from .supervisor import Supervisor
@@ -0,0 +1,42 @@
+import inspect
+import traceback
+
+from logzero import logger
+
+from ..net.stream import encode, decode
+
+
+async def call_inline(fn, *args, **kwargs):
+    """Call `fn` on the event loop, awaiting its result if it returns an awaitable."""
+    result = fn(*args, **kwargs)
+    if inspect.isawaitable(result):
+        result = await result
+
+    return result
+
+
+def call_batch(fn, arglist):
+    """Call the plain function `fn` for each tuple of arguments in `arglist`, see `Orchestrator.batch`."""
+    results = []
+    for args in arglist:
+        try:
+            results.append((True, fn(*args)))
+        except Exception:
+            logger.exception("Exception in batched work.")
+            results.append((False, traceback.format_exc()))
+
+    return results
+
+
+# Run in the child processes of a process pool. They are handed the pickled payload of a DO_WORK or DO_BATCH message as
+# it was received, and return the result pickled as the stream would. The worker never unpickles the arguments, nor
+# pickles the result again, and neither crosses into the child process as a pickle of the decoded objects.
+
+def call_encoded(fn, payload):
+    args, kwargs, _ = decode(payload)
+    return encode(fn(*args, **kwargs))
+
+
+def call_batch_encoded(fn, payload):
+    arglist, _ = decode(payload)
+    return encode(call_batch(fn, arglist))
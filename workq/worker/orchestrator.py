@@ -1,44 +1,29 @@
 import asyncio
+import inspect
+import os
+import socket
 import traceback
 import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
 
 from logzero import logger
 
-from ..net.messages import supports_interface, ping, error_guard, Types, Keys, work_result, work_failed
+from ..net.messages import supports_interface, probe, error_guard, Types, Flags, work_result, work_failed, \
+    batch_result, encoded_result, release_work, work_item, grant_credit, detached_completed, leave, STREAM_WINDOW
+from ..net.flow import ItemStream
+from ..net.upload import UploadRef, UploadException
+from .executor import call_inline, call_batch, call_encoded, call_batch_encoded
 from .stream import StreamWrapper
 
+# A ping times out after this many round trip times, but no sooner than `MIN_PING_TIMEOUT` seconds
+PING_TIMEOUT_RTTS = 8
+MIN_PING_TIMEOUT = 1.0
+# Pings in a row that go unanswered, on an otherwise silent connection, before the server is taken for dead
+MAX_MISSED_PINGS = 3
 
-class PingObserver:
-    def __init__(self):
-        self.subscription = None
-        self.ping_event = asyncio.Event()
-
-    def start(self, observable):
-        self.subscription = observable.subscribe(self)
-
-    async def on_no_ping(self, corutine_producer, timeout=10):
-        try:
-            await asyncio.wait_for(self.ping_event.wait(), timeout=timeout)
-        except asyncio.futures.TimeoutError:
-            await corutine_producer()
-
-    async def got_response_in(self, seconds=10):
-        try:
-            await asyncio.wait_for(self.ping_event.wait(), timeout=seconds)
-            return True
-        except asyncio.futures.TimeoutError:
-            return False
-
-    def on_next(self, message):
-        if message[Keys.TYPE] == Types.PING:
-            self.ping_event.set()
-            self.subscription.dispose()
-
-    def on_error(self, error):
-        pass
-
-    def on_complete(self):
-        pass
+# Seconds that completed detached work may wait to be reported, so the completions are reported together
+REPORT_DELAY = 0.005
 
 
 class Handle:
@@ -53,29 +38,66 @@ class Handle:
         return self.stream.own_ip()
 
     async def ping(self):
-        observer = PingObserver()
-        observer.start(self.stream.observable)
-
-        await self.stream.send(ping)
-        return await observer.got_response_in(seconds=3)
+        return await self.stream.ping(timeout=3) is not None
 
 
 class Orchestrator:
-    def __init__(self, addr, port, retry_timeout=1, keepalive_every=4):
+    def __init__(self, addr, port, retry_timeout=1, keepalive_every=4, capacity=16, prefetch=0, threads=None,
+                 processes=None, name=None):
+        """
+        :param keepalive_every: Seconds the connection may be quiet before the worker checks the server is alive.
+        :param capacity: The number of tasks this worker runs at once.
+        :param prefetch: The number of tasks the server may send ahead of those running, to wait on the worker for a
+        free slot. The server has at most `capacity + prefetch` tasks in flight on this worker, and keeps any others in
+        its queues. Tasks waiting here may be stolen by idle workers.
+        :param threads: The size of the thread pool for tasks implemented to run in threads, see `Task.implement`. By
+        default that of a `concurrent.futures.ThreadPoolExecutor`.
+        :param processes: The size of the process pool for tasks implemented to run in processes. By default the number
+        of CPUs.
+        :param name: Identifies this worker to the server across reconnects, so the calls it routes by affinity keep going
+        to this worker. It must be unique among the workers. By default the host name and process id.
+        """
+        assert capacity > 0, "Capacity must be at least one task"
+        assert prefetch >= 0, "Prefetch can't be negative"
+
         self.addr = addr
         self.port = port
+        self.capacity = capacity
+        self.prefetch = prefetch
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}"
         self.loop = asyncio.get_event_loop()
+        # Slots for running tasks on this worker, and for each task limited to fewer, by task signature
+        self.slots = asyncio.Semaphore(capacity, loop=self.loop)
+        self.limits = {}
         self.tasks = {}
         self.retry_timeout = retry_timeout
+        self.threads = threads
+        self.processes = processes
+        # Thread and process pool, created once a task needs them
+        self.executors = {}
+        # Work run to its end, and whether new work is given back to the server, see `drain`
+        self.runs = 0
+        self.draining = False
 
         self.keepalive_task = None
         self.keepalive_every = keepalive_every
         self.keepalive_pause = False
 
     async def _keepalive(self, stream):
+        """
+        Check that the server is alive while the connection is quiet. Any message received shows it is, so pings are only
+        sent once nothing was received for `keepalive_every` seconds. Their timeout follows the measured round trip time,
+        and an unanswered ping is followed by another right away, so a dead server is noticed soon after it went quiet.
+        """
+        loop = asyncio.get_event_loop()
+        missed = 0
+
         while True:
             try:
-                await asyncio.sleep(self.keepalive_every)
+                quiet = loop.time() - stream.last_received
+                if not missed and quiet < self.keepalive_every:
+                    await asyncio.sleep(self.keepalive_every - quiet)
+                    continue
 
                 if self.keepalive_pause:
                     logger.debug("Keepalive paused, skipping check")
@@ -86,23 +108,29 @@ class Orchestrator:
                     await stream.available.wait()
                     logger.debug("Keepalive resumed")
 
-                observer = PingObserver()
-                observer.start(stream.observable)
-
-                await stream.send(ping)
-
-                async def no_ping():
-                    if not stream.available.is_set():
-                        logger.debug(
-                            f"Server {self.addr}:{self.port} timed out.")
-                        await stream.reconnect()
-
-                await observer.on_no_ping(no_ping, timeout=4)
+                asked = loop.time()
+                timeout = MIN_PING_TIMEOUT if stream.rtt is None else PING_TIMEOUT_RTTS * stream.rtt
+                rtt = await stream.ping(timeout=min(max(timeout, MIN_PING_TIMEOUT), self.keepalive_every))
+
+                if rtt is not None or stream.last_received >= asked:
+                    if rtt is not None:
+                        logger.debug(f"Ping round trip time {rtt * 1000:.1f} ms, average {stream.rtt * 1000:.1f} ms.")
+                    missed = 0
+                    continue
+
+                missed += 1
+                if missed >= MAX_MISSED_PINGS:
+                    logger.warning(f"Server {self.addr}:{self.port} timed out, reconnecting.")
+                    missed = 0
+                    stream.abort()
+                    stream.last_received = loop.time()
             except BrokenPipeError:
                 if not stream.available.is_set():
                     logger.warning("Connection is closed. Reconnecting")
                     await stream.reconnect()
 
+            except asyncio.CancelledError:
+                raise
             except:
                 logger.exception("Unknown exception in keepalive.")
 
@@ -117,9 +145,23 @@ class Orchestrator:
 
         @stream.on_connect
         async def on_connect():
+            stream.tasks = {}
+            stream.running = {}
+            stream.pending = set()
+            stream.credits = {}
+            stream.uploads = {}
+            stream.completed = 0
+            if stream.report is not None:
+                stream.report.cancel()
+                stream.report = None
+
             for interface in interfaces:
-                await stream.send(supports_interface(interface))
-                error_guard(await stream.decode())
+                await stream.send(supports_interface(interface, self.capacity + self.prefetch, self.name))
+                response = await stream.decode()
+                error_guard(response)
+
+                for signature, task_id in response.payload['tasks'].items():
+                    stream.tasks[task_id] = self.tasks[signature]
 
         await stream.connect(self.addr, self.port)
 
@@ -127,7 +169,7 @@ class Orchestrator:
 
         def receive(message):
             try:
-                type = message[Keys.TYPE]
+                type = message.type
 
                 if type not in Types.all:
                     logger.critical(f"Unknown message type {type}")
@@ -138,48 +180,402 @@ class Orchestrator:
                         f"Message type {type} does not have an handler.")
                     return
 
+                if type in (Types.DO_WORK, Types.DO_BATCH):
+                    # Until the handler starts on it, the server may steal it back
+                    stream.pending.add(message.work_id)
+
                 handler = dispatch_table[type]
                 asyncio.ensure_future(handler(self, stream, message))
             except:
                 logger.exeption("Unexpected exception in message handling")
 
-        def teardown():
+        def teardown(receiver):
+            if not receiver.cancelled():
+                logger.critical(f"Receiving from the server failed: {receiver.exception()!r}")
+
             stream.close()
             shutdown_event.set()
 
-        stream.observable.subscribe(receive, logger.critical, teardown)
+        receiver = stream.listen(receive)
+        receiver.add_done_callback(teardown)
 
         async def shutdown():
             done, pending = await asyncio.wait([shutdown_event.wait(), self._keepalive(stream)], return_when=concurrent.futures.FIRST_COMPLETED)
 
             for task in pending:
                 task.cancel()
+            receiver.cancel()
+
+            executors, self.executors = self.executors, {}
+            for executor in executors.values():
+                executor.shutdown(wait=False)
 
             return done
 
         return Handle(shutdown(), stream)
 
     async def work(self, stream, msg):
-        work_id = msg[Keys.WORK_ID]
+        if msg.work_id not in stream.pending:
+            return  # Stolen or cancelled already
+
+        detached = bool(msg.flags & Flags.DETACHED)
+        try:
+            task = stream.tasks[msg.task_id]
+        except KeyError:
+            return await self.unreadable(stream, msg.work_id, detached)
+
+        implementation = task.implementation
+        executor = self.executor(task)
+        result_message = work_result
+
+        # Uploads are registered before the first await, so no chunk arrives before its stream exists
+        uploads = []
+
+        def receive(value):
+            if not isinstance(value, UploadRef):
+                return value
+
+            uploads.append(value.upload_id)
+            upload = stream.uploads[value.upload_id] = ItemStream(partial(self.grant, stream, value.upload_id))
+            return upload
+
+        if isinstance(executor, ProcessPoolExecutor) and msg.encoded_payload is not None and \
+                not msg.flags & Flags.UPLOADS:
+            # The payload is only unpickled in the child process, which returns the result pickled for the stream. The
+            # deadline in the payload is left to the server, which cancels the work once it passes
+            call, timeout = partial(call_encoded, implementation, msg.encoded_payload), None
+            result_message = encoded_result
+        else:
+            try:
+                args, kwargs, timeout = msg.payload
+            except Exception:
+                return await self.unreadable(stream, msg.work_id, detached)
 
-        task = self.tasks[msg[Keys.TASK]]
-        args, kwargs = msg[Keys.ARGS], msg[Keys.KWARGS]
+            args = [receive(value) for value in args]
+            kwargs = {name: receive(value) for name, value in kwargs.items()}
+            call = partial(implementation, *args, **kwargs)
 
-        task = task.implementation(*args, **kwargs)
+        running = None
         try:
-            result = await task
-        except Exception as e:
+            async with self.slot(task):
+                if not self.claim(stream, msg.work_id):
+                    return
+
+                if self.draining and not detached:
+                    # Not started, so the server can start it elsewhere
+                    await stream.send(release_work(msg.work_id, True))
+                    return
+
+                if executor is not None:
+                    running = executor.submit(call)
+                    work = asyncio.wrap_future(running, loop=self.loop)
+                elif inspect.iscoroutinefunction(implementation) or inspect.isasyncgenfunction(implementation):
+                    work = call()
+                else:
+                    work = call_inline(call)
+
+                items = inspect.isasyncgen(work) and not detached
+                if items:
+                    work = self.stream_items(stream, msg.work_id, work)
+                elif inspect.isasyncgen(work):
+                    work = drain(work)
+
+                await self.run(stream, msg.work_id, work, timeout, result_message, detached, items)
+                await self.settle(running)
+        finally:
+            for upload_id in uploads:
+                stream.uploads.pop(upload_id, None)
+
+    async def work_batch(self, stream, msg):
+        work_id = msg.work_id
+        if work_id not in stream.pending:
+            return
+
+        try:
+            task = stream.tasks[msg.task_id]
+        except KeyError:
+            return await self.unreadable(stream, work_id)
+
+        implementation = task.implementation
+        executor = self.executor(task)
+
+        if isinstance(executor, ProcessPoolExecutor) and msg.encoded_payload is not None:
+            call, timeout = partial(call_batch_encoded, implementation, msg.encoded_payload), None
+            result_message = encoded_result
+        else:
+            try:
+                arglist, timeout = msg.payload
+            except Exception:
+                return await self.unreadable(stream, work_id)
+
+            call, result_message = partial(call_batch, implementation, arglist), batch_result
+
+        running = None
+        async with self.slot(task):
+            if not self.claim(stream, work_id):
+                return
+
+            if self.draining:
+                await stream.send(release_work(work_id, True))
+                return
+
+            # A batch in an executor runs there as a whole
+            if executor is None:
+                work = self.batch(implementation, arglist)
+            else:
+                running = executor.submit(call)
+                work = asyncio.wrap_future(running, loop=self.loop)
+
+            await self.run(stream, work_id, work, timeout, result_message)
+            await self.settle(running)
+
+    async def unreadable(self, stream, work_id, detached=False):
+        """Fail work whose task or arguments this worker can't read, instead of running it."""
+        logger.exception("Exception in work scheduling.")
+        trace = traceback.format_exc()
+        if not self.claim(stream, work_id):
+            return  # Cancelled already, and reported as such
+
+        if detached:
+            self.completed(stream)
+        else:
+            await stream.send(work_failed(work_id, trace))
+
+    async def settle(self, running):
+        """
+        Wait for work in an executor that timed out or was cancelled to return all the same, as a thread or process can't
+        be interrupted, so it keeps its slot until then.
+        :param running: The `concurrent.futures.Future` of the work, or None if it did not run in an executor.
+        """
+        if running is not None and not running.done():
+            logger.debug("Waiting for abandoned work to return.")
+            await asyncio.wait([asyncio.wrap_future(running, loop=self.loop)], loop=self.loop)
+
+    def slot(self, task):
+        """
+        :return: An async context manager holding a slot to run `task` in, once the worker and any concurrency limit
+        of the task have one free.
+        """
+        if task.concurrency is None or task.concurrency >= self.capacity:
+            return Slots(self.slots)
+
+        try:
+            limit = self.limits[task.signature]
+        except KeyError:
+            limit = self.limits[task.signature] = asyncio.Semaphore(task.concurrency, loop=self.loop)
+
+        # The task's slot is taken first, so calls waiting for it do not hold up other tasks
+        return Slots(limit, self.slots)
+
+    async def batch(self, implementation, arglist):
+        results = []
+        for args in arglist:
+            try:
+                result = implementation(*args)
+                if inspect.isawaitable(result):
+                    result = await result
+
+                results.append((True, result))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Exception in batched work.")
+                results.append((False, traceback.format_exc()))
+
+        return results
+
+    async def stream_items(self, stream, work_id, items):
+        """Send the items of an async generator as they are produced, for as long as the server grants credit."""
+        credit = stream.credits[work_id] = asyncio.Semaphore(STREAM_WINDOW)
+        try:
+            async for item in items:
+                await credit.acquire()
+                # Cancelled by the server or the deadline partway through an item, the rest of it is still sent
+                await stream.send(work_item(work_id, item))
+        finally:
+            stream.credits.pop(work_id, None)
+            await items.aclose()
+
+    async def credit(self, stream, msg):
+        credit = stream.credits.get(msg.work_id)
+        if credit is not None:
+            for _ in range(msg.payload):
+                credit.release()
+
+    def executor(self, task):
+        """:return: The executor to run the implementation of `task` in, or None to run it on the event loop."""
+        executor = task.executor
+        if executor is None or isinstance(executor, concurrent.futures.Executor):
+            return executor
+
+        try:
+            return self.executors[executor]
+        except KeyError:
+            if executor == 'thread':
+                pool = ThreadPoolExecutor(self.threads)
+            else:
+                pool = ProcessPoolExecutor(self.processes)
+
+            self.executors[executor] = pool
+            return pool
+
+    def grant(self, stream, upload_id, chunks):
+        sending = asyncio.ensure_future(stream.send(grant_credit(upload_id, chunks)))
+        sending.add_done_callback(lambda sending: sending.cancelled() or sending.exception())
+
+    async def data(self, stream, msg):
+        upload = stream.uploads.get(msg.work_id)
+        if upload is None:
+            return  # The work using it has ended
+
+        if msg.error:
+            del stream.uploads[msg.work_id]
+            upload.finish(UploadException(msg.payload))
+        elif msg.payload is None:
+            del stream.uploads[msg.work_id]
+            upload.finish()
+        else:
+            upload.put(msg.payload)
+
+    async def run(self, stream, work_id, work, timeout, result_message, detached=False, items=False):
+        """
+        Run `work` until it completes, times out or is cancelled by the server, and send the server its outcome. The
+        outcome of detached work is not sent, it is only counted, see `completed`.
+        :param items: Whether `work` streams its result, so its outcome ends the stream.
+        """
+        if timeout is not None:
+            work = asyncio.wait_for(work, timeout)
+
+        running = stream.running[work_id] = asyncio.ensure_future(work)
+        try:
+            result = await running
+        except asyncio.CancelledError:
+            logger.debug(f"Work {work_id} cancelled by the server.")
+            outcome = work_failed(work_id, "Cancelled by the server.")
+        except Exception:
             logger.exception("Exception in work scheduling.")
-            await stream.send(work_failed(work_id, traceback.format_exc()))
+            outcome = work_failed(work_id, traceback.format_exc())
+        else:
+            outcome = result_message(work_id, result)
+        finally:
+            stream.running.pop(work_id, None)
+            self.runs += 1
+
+        if detached:
+            self.completed(stream)
             return
 
-        await stream.send(work_result(work_id, result))
+        if items:
+            outcome.flags |= Flags.ITEMS
+        try:
+            await stream.send(outcome)
+        except OSError:
+            raise  # The connection is lost, and the server fails the work over
+        except Exception:
+            # The result could not be pickled, so nothing of it was sent
+            logger.exception("Exception in sending the result.")
+            failure = work_failed(work_id, traceback.format_exc())
+            failure.flags |= outcome.flags & Flags.ITEMS
+            await stream.send(failure)
+
+    def completed(self, stream):
+        """
+        Count a completed detached work, to be reported to the server along with any others that complete within
+        `REPORT_DELAY`, or as soon as half the capacity of the worker is waiting to be reported.
+        """
+        stream.completed += 1
+        if stream.completed >= max(1, self.capacity // 2):
+            self.report(stream)
+        elif stream.report is None:
+            stream.report = asyncio.get_event_loop().call_later(REPORT_DELAY, self.report, stream)
+
+    def report(self, stream):
+        if stream.report is not None:
+            stream.report.cancel()
+            stream.report = None
+
+        completed, stream.completed = stream.completed, 0
+        sending = asyncio.ensure_future(stream.send(detached_completed(completed)))
+        sending.add_done_callback(lambda sending: sending.cancelled() or sending.exception())
+
+    def claim(self, stream, work_id):
+        """:return: Whether `work_id` was still pending, and can be started. Otherwise it was stolen or cancelled."""
+        try:
+            stream.pending.remove(work_id)
+            return True
+        except KeyError:
+            return False
+
+    async def cancel(self, stream, msg):
+        if self.claim(stream, msg.work_id):
+            await stream.send(work_failed(msg.work_id, "Cancelled by the server."))
+            return
+
+        running = stream.running.get(msg.work_id)
+        if running is not None:
+            running.cancel()
+
+    async def drain(self, stream, timeout=None):
+        """
+        Stop starting work, and tell the server to send no more. Work it sent before it got the message is given back to
+        it as if it was stolen, except for detached work, which can't be given back.
+        :return: Once no work is running or waiting, or after `timeout` seconds.
+        """
+        self.draining = True
+        await stream.send(leave)
+        loop = asyncio.get_event_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+
+        while stream.running or stream.pending:
+            if deadline is not None and loop.time() >= deadline:
+                logger.warning(f"Stopped draining with {len(stream.running)} tasks still running.")
+                return
+
+            await asyncio.sleep(0.1)
+
+    async def steal(self, stream, msg):
+        await stream.send(release_work(msg.work_id, self.claim(stream, msg.work_id)))
 
     async def recv_ping(self, stream, msg):
+        if msg.flags & Flags.PROBE:
+            await stream.send(probe)
+            return
+
         logger.log(0, "Recived ping from server.")
 
 
+class Slots:
+    """Async context manager holding a slot of each of `semaphores` while in its body, taken in order."""
+
+    def __init__(self, *semaphores):
+        self.semaphores = semaphores
+
+    async def __aenter__(self):
+        for taken, semaphore in enumerate(self.semaphores):
+            try:
+                await semaphore.acquire()
+            except BaseException:
+                for held in self.semaphores[:taken]:
+                    held.release()
+                raise
+
+    async def __aexit__(self, *exc_info):
+        for semaphore in self.semaphores:
+            semaphore.release()
+
+
+async def drain(items):
+    """Run an async generator to its end, discarding the items it yields."""
+    async for _ in items:
+        pass
+
+
 dispatch_table = {
     Types.DO_WORK: Orchestrator.work,
+    Types.DO_BATCH: Orchestrator.work_batch,
+    Types.CANCEL: Orchestrator.cancel,
+    Types.STEAL: Orchestrator.steal,
+    Types.CREDIT: Orchestrator.credit,
+    Types.DATA: Orchestrator.data,
     Types.PING: Orchestrator.recv_ping
 }
@@ -1,13 +1,14 @@
 import asyncio
-import functools
 import socket
 
-import rx.concurrency
 from logzero import logger
-from rx import Observable
 
+from workq.net.messages import Types, Flags, ping
 from workq.net.stream import Stream
 
+# Weight of the newest sample in the moving average of the round trip time
+SMOOTHING = 0.2
+
 
 class StreamWrapper:
     def __init__(self, retry_timeout, loop=asyncio.get_event_loop()):
@@ -19,6 +20,23 @@ class StreamWrapper:
         self.address = None
         self.on_connect_callback = None
         self.connect_task = None
+        # Tasks by the id the server assigned to them on this connection
+        self.tasks = {}
+        # Work being done, and work received but not started yet, by work id on this connection
+        self.running = {}
+        self.pending = set()
+        # Items each streamed result may still send, by work id, and the uploads being received, by upload id
+        self.credits = {}
+        self.uploads = {}
+        # Detached work completed but not reported to the server yet, and the pending report
+        self.completed = 0
+        self.report = None
+        # Futures of the callers of `ping` waiting for a reply
+        self.ping_waiters = set()
+        # Loop time a message was last received at, and the moving average of the round trip time of pings in seconds,
+        # once measured
+        self.last_received = loop.time()
+        self.rtt = None
 
         @self.on_connect
         async def callback():
@@ -32,11 +50,11 @@ class StreamWrapper:
         self.socket.close()
         await self._connect()
 
-    async def send(self, msg):
+    async def send(self, msg, materialize=True):
         while True:
             await self.available.wait()
             try:
-                await self.backing.send(msg)
+                await self.backing.send(msg, materialize)
                 return
             except ConnectionResetError:
                 logger.warning(
@@ -56,6 +74,13 @@ class StreamWrapper:
     def close(self):
         self.socket.close()
 
+    def abort(self):
+        """Cut the connection, which the receive loop takes as the server closing it, and reconnects."""
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
     def own_ip(self):
         return self.socket.getsockname()[0]
 
@@ -65,7 +90,8 @@ class StreamWrapper:
 
     async def _connect(self):
         self.socket = await self.connect_retry()
-        self.backing = Stream(self.socket)
+        self.backing = Stream(self.socket, loop=self.loop)
+        self.last_received = self.loop.time()
         self.available.set()
 
         await self.on_connect_callback()
@@ -84,41 +110,51 @@ class StreamWrapper:
                                 "second(s).")
                 await asyncio.sleep(self.retry_timeout)
 
-    @property
-    @functools.lru_cache()
-    def observable(self) -> Observable:
-        logger.debug(f"Creating stream observable.")
-
-        def subscribe(obs):
-            logger.debug(f"Subscribed to stream observable.")
-
-            async def push_values():
-                while True:
-                    try:
-                        obs.on_next(await self.decode())
-                    except EOFError:
-                        if self.available.is_set():
-                            logger.info(
-                                "Orchestrator shut down. Attempting to reconnect.")
-                            await self.reconnect()
-                        else:
-                            await self.available.wait()
-
-                    except asyncio.futures.CancelledError:
-                        logger.warning("Push-values future cancelled")
-                        return
-
-                logger.error("Push-values unexpectedly shutdown.")
+    def listen(self, handler):
+        """
+        Receive messages until cancelled, passing each to `handler`, and resolving the waiters of `ping` on a ping from
+        the server.
+        :return: The task receiving the messages.
+        """
+        return asyncio.ensure_future(self._receive(handler), loop=self.loop)
 
-            task = asyncio.ensure_future(push_values())
-
-            def dispose():
-                logger.debug(f"Disposed of stream observable subscription.")
-                task.cancel()
-
-            return dispose
-
-        return Observable.create(subscribe).subscribe_on(scheduler).share()
-
-
-scheduler = rx.concurrency.AsyncIOScheduler(asyncio.get_event_loop())
+    async def _receive(self, handler):
+        while True:
+            try:
+                message = await self.decode()
+            except EOFError:
+                if self.available.is_set():
+                    logger.info("Orchestrator shut down. Attempting to reconnect.")
+                    await self.reconnect()
+                else:
+                    await self.available.wait()
+                continue
+
+            self.last_received = self.loop.time()
+
+            if message.type == Types.PING and not message.flags & Flags.PROBE:
+                for waiter in self.ping_waiters:
+                    if not waiter.done():
+                        waiter.set_result(None)
+
+            handler(message)
+
+    async def ping(self, timeout):
+        """
+        Measure the round trip time to the server, which is also folded into `rtt`.
+        :return: The round trip time in seconds, or None if the server did not answer within `timeout` seconds.
+        """
+        reply = self.loop.create_future()
+        self.ping_waiters.add(reply)
+        try:
+            await self.send(ping)
+            sent = self.loop.time()
+            await asyncio.wait_for(reply, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self.ping_waiters.discard(reply)
+
+        rtt = self.loop.time() - sent
+        self.rtt = rtt if self.rtt is None else self.rtt + SMOOTHING * (rtt - self.rtt)
+        return rtt
@@ -0,0 +1,144 @@
+import asyncio
+import os
+import signal
+import socket
+import time
+
+from logzero import logger
+
+from .orchestrator import Orchestrator
+
+# Exit status of a worker process that stopped to be replaced by a fresh one
+RECYCLE = 75
+
+# Seconds between checks of whether a worker process is due to be recycled
+CHECK_EVERY = 1
+
+
+class Supervisor:
+    """
+    Runs `processes` worker processes on this host, forked from this one, each joining the server at `addr` and `port`
+    with `interfaces` as an `Orchestrator` created with `options`. Workers that crash are started again, and workers
+    that exit because the server shut down are not.
+
+    To contain leaks in long running task code, a worker is recycled after running `max_tasks` tasks, or once its
+    resident memory exceeds `max_rss` bytes. It tells the server to send it no more work, waits at most `drain_timeout`
+    seconds for the tasks it is running, and is replaced by a fresh process.
+    """
+
+    def __init__(self, addr, port, *interfaces, processes=None, pin=False, max_tasks=None, max_rss=None,
+                 drain_timeout=60, restart_delay=1, **options):
+        """
+        :param processes: The number of worker processes, by default one for each CPU.
+        :param pin: Pin each worker process to a CPU of its own, as far as there are enough. Linux only.
+        :param restart_delay: Seconds to wait before starting a crashed worker again.
+        """
+        self.addr = addr
+        self.port = port
+        self.interfaces = interfaces
+        self.processes = processes or os.cpu_count()
+        self.cpus = sorted(os.sched_getaffinity(0)) if pin else None
+        self.max_tasks = max_tasks
+        self.max_rss = max_rss
+        self.drain_timeout = drain_timeout
+        self.restart_delay = restart_delay
+        # Workers are named by their index, so a recycled or restarted worker takes the place of the one before it
+        self.name = options.pop('name', None) or socket.gethostname()
+        self.options = options
+
+        # Worker processes by pid, as their index among the workers
+        self.children = {}
+        self.stopping = False
+
+    def run(self):
+        """
+        Start the workers, and supervise them until they all exit, or this process is interrupted or terminated, which
+        terminates the workers. Must not be called with an event loop running in this process.
+        """
+        for index in range(self.processes):
+            self.start(index)
+
+        previous = {sig: signal.signal(sig, self.stop) for sig in (signal.SIGINT, signal.SIGTERM)}
+        try:
+            while self.children:
+                pid, status = os.wait()
+                index = self.children.pop(pid, None)
+                if index is None or self.stopping:
+                    continue
+
+                if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+                    logger.info(f"Worker {index} exited.")
+                elif os.WIFEXITED(status) and os.WEXITSTATUS(status) == RECYCLE:
+                    logger.info(f"Worker {index} recycled.")
+                    self.start(index)
+                else:
+                    logger.warning(f"Worker {index} crashed with status {status:#x}, restarting it.")
+                    time.sleep(self.restart_delay)
+                    if not self.stopping:
+                        self.start(index)
+        finally:
+            for sig, handler in previous.items():
+                signal.signal(sig, handler)
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def start(self, index):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = index
+            return
+
+        status = 1
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)  # Interrupting the supervisor stops the workers in order
+
+            if self.cpus is not None:
+                os.sched_setaffinity(0, {self.cpus[index % len(self.cpus)]})
+
+            # The event loop of the supervisor shares its selector with every process forked from it
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            status = loop.run_until_complete(self.serve(index))
+        except BaseException:
+            logger.exception(f"Worker {index} failed.")
+        finally:
+            os._exit(status)
+
+    async def serve(self, index):
+        """Run worker `index` in this process. :return: Its exit status."""
+        worker = Orchestrator(self.addr, self.port, name=f"{self.name}/{index}", **self.options)
+        handle = await worker.join(*self.interfaces)
+        shutdown = asyncio.ensure_future(handle.run_until_complete())
+
+        while True:
+            done, _ = await asyncio.wait([shutdown], timeout=CHECK_EVERY)
+            if done:
+                return 0
+
+            if self.worn_out(worker):
+                await worker.drain(handle.stream, self.drain_timeout)
+                return RECYCLE
+
+    def worn_out(self, worker):
+        if self.max_tasks is not None and worker.runs >= self.max_tasks:
+            return True
+
+        return self.max_rss is not None and rss() > self.max_rss
+
+
+def rss():
+    """:return: The resident memory of this process in bytes."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        # Not Linux, so settle for the peak, which macOS reports in bytes
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss